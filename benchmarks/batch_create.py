@@ -0,0 +1,61 @@
+"""
+Batch Create Benchmark
+
+Compares the throughput of creating products one at a time through
+POST /api/products with creating them through POST /api/products:batch
+
+Run against the configured database with:
+  python -m benchmarks.batch_create [count] [batch_size]
+"""
+import sys
+import time
+from service.models import db
+from service.service import app, init_db
+from tests.product_factory import ProductFactory
+
+
+def reset_database():
+    """ Drops and recreates the tables so both runs start empty """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def one_at_a_time(client, products):
+    """ Creates every product with its own request and transaction """
+    for product in products:
+        resp = client.post("/api/products", json=product, content_type="application/json")
+        assert resp.status_code == 201, resp.data
+
+
+def batched(client, products, batch_size):
+    """ Creates the products in batches of batch_size """
+    for start in range(0, len(products), batch_size):
+        resp = client.post(
+            "/api/products:batch", json=products[start:start + batch_size], content_type="application/json"
+        )
+        assert resp.status_code == 201, resp.data
+
+
+def run(count, batch_size):
+    """ Times both paths and prints their throughput """
+    init_db()
+    app.logger.disabled = True
+    client = app.test_client()
+    products = [ProductFactory().serialize() for _ in range(count)]
+
+    for label, create in (("one at a time", lambda: one_at_a_time(client, products)),
+                          ("batch of {}".format(batch_size), lambda: batched(client, products, batch_size))):
+        reset_database()
+        start = time.perf_counter()
+        create()
+        elapsed = time.perf_counter() - start
+        print("{:<20} {:>8} products in {:7.3f}s  {:>10.0f} products/s".format(
+            label, count, elapsed, count / elapsed))
+    reset_database()
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 500)
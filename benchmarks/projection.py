@@ -0,0 +1,66 @@
+"""
+Column Projection Benchmark
+
+Compares the time and peak memory of loading every Product as an ORM
+instance with Product.all() with loading rows of plain column values
+through Product.find_by(fields=...), for all the fields of product_model
+and for id, name and price only
+
+Run against the configured database with:
+  python -m benchmarks.projection [rows]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from service.models import db, Product
+from service.render import PRODUCT_FIELDS
+from service.service import app, init_db
+from tests.product_factory import ProductFactory
+
+
+def measure(load):
+    """ Returns the rows and seconds of load() and the peak bytes it allocates, each in a fresh session """
+    db.session.remove()
+    gc.collect()
+    start = time.perf_counter()
+    rows = load()
+    elapsed = time.perf_counter() - start
+    del rows
+    # tracing slows allocations down, so the peak comes from a second, untimed run
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    rows = load()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, elapsed, peak
+
+
+def run(count):
+    """ Loads count Products every way and prints the cost of each """
+    init_db()
+    app.logger.disabled = True
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    for start in range(0, count, 10000):
+        Product.create_many([ProductFactory() for _ in range(min(10000, count - start))])
+
+    loads = (("Product.all()", Product.all),
+             ("fields=all", lambda: Product.find_by(fields=PRODUCT_FIELDS).all()),
+             ("fields=id,name,price", lambda: Product.find_by(fields=("id", "name", "price")).all()))
+    for label, load in loads:
+        load()  # warm up the baked query cache
+        rows, elapsed, peak = measure(load)
+        assert len(rows) == count
+        print("{:<22} {:>8} rows in {:7.3f}s  {:>7.2f} us/row  peak {:>7.1f} MB  {:>5.0f} B/row".format(
+            label, count, elapsed, elapsed / count * 1e6, peak / 2 ** 20, peak / count))
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
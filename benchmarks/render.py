@@ -0,0 +1,77 @@
+"""
+Product Rendering Benchmark
+
+Compares the per-row cost of encoding a list of Products the old way,
+Product.serialize() then marshal() with product_model then json.dumps(),
+with service.render, with and without orjson. Then times a full
+GET /api/products of the same rows from the configured database
+
+Run with:
+  python -m benchmarks.render [rows] [repeat]
+"""
+import sys
+import json
+import time
+from unittest.mock import patch
+from flask_restplus import marshal
+from service import render
+from service.models import db, Product
+from service.service import app, init_db, product_model, result_cache
+from tests.product_factory import ProductFactory
+
+
+def marshalled(products):
+    """ Encodes the Products the way the list endpoint used to """
+    return json.dumps(marshal([product.serialize() for product in products], product_model)).encode("utf-8") + b"\n"
+
+
+def stdlib_render(products):
+    """ Encodes the Products with service.render and the json module """
+    with patch("service.render.orjson", None):
+        return render.render_products(products)
+
+
+def best_of(repeat, encode, products):
+    """ Returns the fastest of repeat runs of encode in seconds """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(products)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(rows, repeat):
+    """ Times every encoder and a full list request and prints the cost per row """
+    init_db()
+    app.logger.disabled = True
+    products = [ProductFactory(id=product_id) for product_id in range(1, rows + 1)]
+    encoders = [("marshal + json", marshalled), ("render + json", stdlib_render)]
+    if render.orjson is not None:
+        encoders.append(("render + orjson", render.render_products))
+    for label, encode in encoders:
+        elapsed = best_of(repeat, encode, products)
+        print("{:<18} {:>8} rows in {:7.4f}s  {:>8.2f} us/row".format(label, rows, elapsed, elapsed / rows * 1e6))
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    Product.create_many([ProductFactory() for _ in range(rows)])
+    client = app.test_client()
+
+    def list_request(_products):
+        result_cache.clear()
+        resp = client.get("/api/products")
+        assert resp.status_code == 200, resp.data
+
+    elapsed = best_of(repeat, list_request, None)
+    print("{:<18} {:>8} rows in {:7.4f}s  {:>8.2f} us/row".format("GET /api/products", rows, elapsed, elapsed / rows * 1e6))
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 5)
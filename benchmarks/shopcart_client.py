@@ -0,0 +1,50 @@
+"""
+Shopcart Client Benchmark
+
+Compares the latency of shopcart calls made with module level
+requests.get/post, which open a new connection for every call, with the
+pooled keep-alive session of service.shopcart, against a local stand-in
+shopcart server
+
+Run with:
+  python -m benchmarks.shopcart_client [calls]
+"""
+import sys
+import time
+import requests
+from service import shopcart
+from tests.shopcart_server import ShopcartServer
+
+HEADER = {'Content-Type': 'application/json'}
+
+
+def purchase_unpooled(endpoint, user_id):
+    """ Looks up the shopcart of a user and adds an item the old way """
+    cart_id = requests.get('{}?user_id={}'.format(endpoint, user_id)).json()[0]['id']
+    requests.post("{}/{}/items".format(endpoint, cart_id), headers=HEADER, json={"sku": 1, "amount": 1})
+
+
+def purchase_pooled(endpoint, user_id):
+    """ Looks up the shopcart of a user and adds an item through the pooled session """
+    cart_id = shopcart.get_shopcarts(endpoint, user_id).json()[0]['id']
+    shopcart.add_item_to_shopcart("{}/{}/items".format(endpoint, cart_id), HEADER, {"sku": 1, "amount": 1})
+
+
+def run(calls):
+    """ Times both ways of calling the shopcart service and prints their latency """
+    with ShopcartServer() as server:
+        shopcart.create_shopcart(server.endpoint, HEADER, {"user_id": 1})
+        for label, purchase in (("requests.get/post", purchase_unpooled), ("pooled session", purchase_pooled)):
+            server.connections.clear()
+            timings = []
+            for _ in range(calls):
+                start = time.perf_counter()
+                purchase(server.endpoint, 1)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print("{:<18} {:>6} purchases  mean {:7.3f}ms  p99 {:7.3f}ms  {:>5} connections".format(
+                label, calls, 1000 * sum(timings) / calls, 1000 * timings[int(calls * 0.99) - 1], len(server.connections)))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,62 @@
+"""
+Gunicorn Configuration for Production
+
+The application is loaded once in the master before the workers are
+forked, so the schema is created or upgraded a single time and the
+workers share the memory of the loaded code copy-on-write. The master
+closes its connections before forking, so each worker opens its own.
+
+    gunicorn --config=gunicorn.conf.py service:app
+"""
+import gc
+import os
+import multiprocessing
+import config as settings
+
+# Connections a worker may open to each database
+CONNECTIONS_PER_WORKER = settings.DATABASE_POOL_SIZE + settings.DATABASE_MAX_OVERFLOW
+
+
+def cpu_count():
+    """ Returns the number of CPUs this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def default_workers():
+    """ Returns 2 * CPUs + 1 workers, or as many as the pools of the workers fit in DATABASE_MAX_CONNECTIONS """
+    return max(1, min(cpu_count() * 2 + 1, settings.DATABASE_MAX_CONNECTIONS // CONNECTIONS_PER_WORKER))
+
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+# WEB_CONCURRENCY caps the workers on hosts that report more cores than the memory allows
+workers = int(os.getenv("WEB_CONCURRENCY") or default_workers())
+# Threads of a worker share its connection pool, keep them within
+# DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = timeout
+keepalive = 5
+# Restart workers now and then so a slow leak cannot grow without bound
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "10000"))
+max_requests_jitter = max_requests // 10
+preload_app = True
+errorlog = "-"
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+
+def when_ready(server):
+    """ Prepares the preloaded application in the master for the workers to be forked """
+    if server.num_workers * CONNECTIONS_PER_WORKER > settings.DATABASE_MAX_CONNECTIONS:
+        server.log.warning("%d workers may open %d connections to each database, more than DATABASE_MAX_CONNECTIONS (%d)",
+                           server.num_workers, server.num_workers * CONNECTIONS_PER_WORKER, settings.DATABASE_MAX_CONNECTIONS)
+    # workers sharing the sockets of the master would interleave their queries
+    from service.service import release_connections  # pylint: disable=import-outside-toplevel
+    release_connections()
+    # a collection in a worker writes to every object it visits, copying the
+    # pages it shares with the master, so keep the loaded objects out of it
+    gc.collect()
+    gc.freeze()
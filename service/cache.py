@@ -0,0 +1,78 @@
+"""
+In-process caches
+
+LRUCache keeps the hottest reads inside the worker process. Entries are
+evicted least recently used first once the cache is full, and expire
+after a time to live so that writes made by other workers show up
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ A bounded, thread safe least recently used cache with a time to live """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, clock=time.monotonic):
+        """
+        Args:
+            maxsize (int): the maximum number of entries, 0 disables the cache
+            ttl (float): the number of seconds an entry stays valid
+            clock (callable): returns the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """ Returns the value cached for key, or default if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """ Caches value under key, evicting the least recently used entries if full """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Removes the entry for key if there is one """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the size and the hit, miss and eviction counters of the cache """
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
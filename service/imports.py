@@ -0,0 +1,210 @@
+"""
+Bulk Imports
+
+Loads CSV and NDJSON uploads of Products in an import worker process next
+to the web workers. The web worker stores an upload in the import_upload
+table with a pending ImportJob and answers at once. The import worker
+claims the job and reads the upload line by line. Every line is validated
+with the rules of Product.deserialize(). The valid rows are loaded in
+chunks, and each chunk is committed together with the progress and the
+rejected lines of the job. On PostgreSQL a chunk goes through COPY FROM
+STDIN into a staging table and one INSERT ... SELECT. On other databases
+it is a single executemany INSERT.
+
+A worker that dies stops committing chunks. Once its job has not been
+updated for IMPORT_STALE_AFTER seconds another worker takes it over and
+resumes after the last chunk that was committed.
+
+Run one or more import workers next to the web workers with:
+
+    python -m service.imports
+"""
+import io
+import csv
+import codecs
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+from service.models import db, Product, CategoryStats, ChangeGeneration, ImportJob, ImportUpload, DataValidationError
+
+logger = logging.getLogger(__name__)
+
+# Media types of the uploads and the format of each
+FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+COLUMNS = ("name", "description", "category", "price")
+
+POSTGRES_STAGING_DDL = (
+    "CREATE TEMP TABLE IF NOT EXISTS product_staging "
+    "(name varchar(63), description varchar(256), category varchar(63), price double precision) "
+    "ON COMMIT DELETE ROWS"
+)
+POSTGRES_COPY_SQL = "COPY product_staging (name, description, category, price) FROM STDIN WITH (FORMAT csv)"
+# version and updated_at only have Python side defaults, so the merge sets them
+POSTGRES_MERGE_SQL = (
+    "INSERT INTO product (name, description, category, price, version, updated_at) "
+    "SELECT name, description, category, price, 1, now() AT TIME ZONE 'utc' FROM product_staging"
+)
+
+
+def submit(fmt, stream):
+    """ Stores an upload with a pending ImportJob for the import workers and returns the job """
+    job = ImportJob(format=fmt)
+    db.session.add(job)
+    db.session.flush()
+    # the job only becomes visible to the workers with the whole upload
+    ImportUpload.store(job.id, stream)
+    db.session.commit()
+    return job
+
+
+def read_lines(job_id):
+    """ Decodes the upload of a job as UTF-8 and yields its lines, without holding it in memory """
+    rest = ""
+    for text in codecs.iterdecode(ImportUpload.read(job_id), "utf-8"):
+        lines = (rest + text).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield rest
+
+
+def read_records(upload, fmt):
+    """ Yields the line number, the record and the parse error of every record of an upload """
+    if fmt == "csv":
+        reader = csv.DictReader(upload)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for number, line in enumerate(upload, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError:
+            yield number, None, "Invalid JSON"
+
+
+def validate(record):
+    """ Returns the column values of a record that passes the rules of the API, or raises DataValidationError """
+    if not isinstance(record, dict):
+        raise DataValidationError("Invalid product: body of request contained bad or no data")
+    product = Product().deserialize(record)
+    if any(getattr(product, column) == "" for column in COLUMNS):
+        raise DataValidationError("Fields cannot be empty.")
+    row = {"price": float(product.price)}
+    for column in COLUMNS[:3]:
+        value = getattr(product, column)
+        length = Product.__table__.c[column].type.length
+        if not isinstance(value, str):
+            raise DataValidationError("Invalid product: {} must be a string".format(column))
+        if len(value) > length:
+            raise DataValidationError("Invalid product: {} is longer than {} characters".format(column, length))
+        row[column] = value
+    return row
+
+
+def load_rows(rows):
+    """ Inserts validated rows of Products in the current transaction """
+    CategoryStats.add([(row["category"], row["price"]) for row in rows])
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(Product.__table__.insert(), rows)
+        return
+    data = io.StringIO()
+    csv.writer(data).writerows([row[column] for column in COLUMNS] for row in rows)
+    data.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute(POSTGRES_STAGING_DDL)
+        cursor.copy_expert(POSTGRES_COPY_SQL, data)
+        cursor.execute(POSTGRES_MERGE_SQL)
+    finally:
+        cursor.close()
+
+
+def commit_chunk(job, rows, errors):
+    """ Loads a chunk of rows and records the progress and rejected lines of the job in one transaction """
+    if rows:
+        load_rows(rows)
+        job.imported += len(rows)
+        ChangeGeneration.bump()
+    job.errors = json.dumps(errors)
+    # a job that keeps committing has a live worker
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    # lookups of ids that did not exist yet are cached as misses
+    Product.cache.clear()
+
+
+def run_import(app, job):
+    """ Imports the upload of a claimed ImportJob, after the lines it already committed """
+    chunk_size = app.config["IMPORT_CHUNK_SIZE"]
+    max_errors = app.config["IMPORT_MAX_ERRORS"]
+    job_id = job.id
+    errors = json.loads(job.errors)
+    committed = job.lines
+    if committed:
+        logger.info("Resuming import %s after %d lines", job_id, committed)
+    try:
+        rows = []
+        for number, (line, record, error) in enumerate(read_records(read_lines(job_id), job.format), 1):
+            if number <= committed:
+                continue
+            job.lines += 1
+            if error is None:
+                try:
+                    rows.append(validate(record))
+                except DataValidationError as invalid:
+                    error = str(invalid)
+            if error is not None:
+                job.rejected += 1
+                if len(errors) < max_errors:
+                    errors.append({"line": line, "message": error})
+            # rejected lines count too, so that the job keeps showing progress
+            if job.lines - committed >= chunk_size:
+                commit_chunk(job, rows, errors)
+                rows = []
+                committed = job.lines
+        commit_chunk(job, rows, errors)
+        job.status = ImportJob.DONE
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception("Import %s failed", job_id)
+        db.session.rollback()
+        job.status = ImportJob.FAILED
+        job.message = str(error)[:255]
+        job.errors = json.dumps(errors)
+    # a worker stopped before this point leaves the job running with its upload, for another to resume
+    ImportUpload.remove(job_id)
+    db.session.commit()
+    logger.info("Import %s %s: %d imported, %d rejected", job_id, job.status, job.imported, job.rejected)
+
+
+def process(app):
+    """ Claims and runs one import, returns whether there was one to run """
+    with app.app_context():
+        stale_before = datetime.utcnow() - timedelta(seconds=app.config["IMPORT_STALE_AFTER"])
+        job = ImportJob.claim(stale_before)
+        if job is None:
+            return False
+        run_import(app, job)
+        return True
+
+
+def run(app):
+    """ Runs the imports until interrupted """
+    logger.info("Waiting for imports")
+    while True:
+        try:
+            ran = process(app)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Running an import failed: %s", error)
+            ran = False
+        if not ran:
+            time.sleep(app.config["IMPORT_INTERVAL"])
+
+
+if __name__ == "__main__":
+    from service import app as service_app
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")
+    run(service_app)
@@ -4,19 +4,240 @@ Models for Product
 All of the models are stored in this module
 """
 import re
+import json
+import itertools
 import logging
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from sqlalchemy.exc import InvalidRequestError
+from datetime import datetime
+from sqlalchemy import func, event, text, select, or_, and_, tuple_, bindparam, inspect, cast, literal_column, Float, Integer
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import InvalidRequestError, DBAPIError
+from service.cache import LRUCache
+from service.pool import engine_options
+from service.replicas import RoutingSQLAlchemy, reads_own_writes, reads_replica, replica_binds
+
+# Create the SQLAlchemy object to be initialized later in init_db(),
+# its sessions send the queries of replica reads to the read replicas
+db = RoutingSQLAlchemy()
+
+# Cache of the queries and compiled SQL built by Product.find_by()
+bakery = baked.bakery()
+
+# Marks a Product.find() lookup that is not in the cache, since None caches a miss
+NOT_CACHED = object()
+
+# Indexes behind the case-insensitive category filter, the price range filter
+# and the sorts of find_by(). The id ends each index so that a sort on price,
+# which the id breaks ties of, is a walk of the index in either direction.
+# Every statement is idempotent so it can run both when the table is created
+# and on every start against an existing table.
+PRODUCT_INDEX_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_product_category_lower_price ON product (lower(category), price, id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_price ON product (price, id)",
+    # a prefix of ix_product_category_lower_price
+    "DROP INDEX IF EXISTS ix_product_category_lower",
+]
+# lower(col) LIKE '%x%' can only use an index through trigrams (pg_trgm)
+TRIGRAM_INDEX_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_product_name_trgm ON product USING gin (lower(name) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_product_description_trgm ON product USING gin (lower(description) gin_trgm_ops)",
+]
+# Columns added after the first release, for tables created before them
+POSTGRES_UPGRADE_DDL = [
+    "ALTER TABLE product ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+    "ALTER TABLE product ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT now()",
+]
+# Full text search: a generated tsvector column on PostgreSQL and an external
+# content FTS5 table kept in sync by triggers on SQLite
+POSTGRES_FULL_TEXT_DDL = [
+    "ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING gin (search_vector)",
+]
+SQLITE_FULL_TEXT_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(name, description, content='product', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+]
+POSTGRES_SEARCH_SQL = (
+    "SELECT product.id, product.name, product.description, product.category, product.price, "
+    "product.version, product.updated_at "
+    "FROM product, plainto_tsquery('english', :terms) AS query "
+    "WHERE product.search_vector @@ query "
+    "ORDER BY ts_rank(product.search_vector, query) DESC, product.id LIMIT :limit"
+)
+SQLITE_SEARCH_SQL = (
+    "SELECT product.id, product.name, product.description, product.category, product.price, "
+    "product.version, product.updated_at "
+    "FROM product_fts JOIN product ON product.id = product_fts.rowid "
+    "WHERE product_fts MATCH :terms "
+    "ORDER BY product_fts.rank, product.id LIMIT :limit"
+)
+
+# Keeps the statistics of a category up to date, one parameter set per category
+CATEGORY_STATS_ADD_SQL = (
+    "INSERT INTO category_stats (category, count, total, minimum, maximum) "
+    "VALUES (:category, :count, :total, :minimum, :maximum) "
+    "ON CONFLICT (category) DO UPDATE SET count = category_stats.count + excluded.count, "
+    "total = category_stats.total + excluded.total, "
+    "minimum = {least}(category_stats.minimum, excluded.minimum), "
+    "maximum = {greatest}(category_stats.maximum, excluded.maximum)"
+)
+CATEGORY_STATS_REMOVE_SQL = [
+    "UPDATE category_stats SET count = count - 1, total = total - :price WHERE category = :category",
+    # the minimum and maximum can only be recomputed, and only when the price was one of them
+    "UPDATE category_stats SET "
+    "minimum = (SELECT min(price) FROM product WHERE lower(category) = :category), "
+    "maximum = (SELECT max(price) FROM product WHERE lower(category) = :category) "
+    "WHERE category = :category AND count > 0 AND (:price <= minimum OR :price >= maximum)",
+    "DELETE FROM category_stats WHERE category = :category AND count <= 0",
+]
+# The version of the tables, indexes and search tables built by create_all()
+# and Product.upgrade_schema(). Bump it with every change to either, so that
+# workers starting against a database already at this version skip both
+SCHEMA_VERSION = 2
+SCHEMA_VERSION_STAMP_SQL = (
+    "INSERT INTO schema_version (id, value) VALUES (1, :value) "
+    "ON CONFLICT (id) DO UPDATE SET value = excluded.value"
+)
+
+# Fills the statistics of the products that were there before the table
+CATEGORY_STATS_BACKFILL_SQL = (
+    "INSERT INTO category_stats (category, count, total, minimum, maximum) "
+    "SELECT lower(category), count(*), sum(price), min(price), max(price) FROM product "
+    "WHERE NOT EXISTS (SELECT 1 FROM category_stats) GROUP BY lower(category)"
+)
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
 
+class ChangeGeneration(db.Model):
+    """
+    Class that represents the change generation of the catalog
+
+    The single row is bumped in the same transaction as every write to the
+    product table, so its value identifies a state of the whole catalog
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls):
+        """ Moves the catalog to the next generation in the current transaction """
+        db.session.execute(cls.__table__.update().where(cls.id == 1).values(value=cls.value + 1))
+
+    @classmethod
+    def current(cls):
+        """ Returns the current generation of the catalog """
+        return db.session.query(cls.value).filter(cls.id == 1).scalar()
+
+
+class SchemaVersion(db.Model):
+    """
+    Class that represents the version of the schema of the database
+
+    The single row is stamped once the schema has been created or upgraded,
+    so that starting a worker costs one query instead of building it again
+    """
+
+    __tablename__ = "schema_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def current(cls, engine):
+        """ Returns the version the schema of a database was stamped with, or None """
+        try:
+            with engine.connect() as connection:
+                return connection.execute(text("SELECT value FROM schema_version WHERE id = 1")).scalar()
+        except DBAPIError:
+            # the table is not there yet
+            return None
+
+    @classmethod
+    def stamp(cls, engine, version):
+        """ Records the version of the schema of a database """
+        with engine.begin() as connection:
+            connection.execute(text(SCHEMA_VERSION_STAMP_SQL), value=version)
+
+
+class CategoryStats(db.Model):
+    """
+    Class that represents the price statistics of a category
+
+    The rows are kept up to date in the same transaction as every write to
+    the product table, so reading them costs a lookup instead of a scan.
+    Categories are case insensitive and kept in lower case
+    """
+
+    __tablename__ = "category_stats"
+
+    category = db.Column(db.String(63), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    minimum = db.Column(db.Float, nullable=False)
+    maximum = db.Column(db.Float, nullable=False)
+
+    def serialize(self):
+        """ Serializes the statistics of a category into a dictionary """
+        return {
+            "category": self.category,
+            "count": self.count,
+            "min_price": self.minimum,
+            "max_price": self.maximum,
+            "avg_price": round(self.total / self.count, 2)
+        }
+
+    @classmethod
+    def add(cls, products):
+        """ Adds the (category, price) of new Products to the statistics in the current transaction """
+        groups = {}
+        for category, price in products:
+            price = float(price)
+            group = groups.setdefault(category.lower(), {"category": category.lower(), "count": 0, "total": 0.0,
+                                                         "minimum": price, "maximum": price})
+            group["count"] += 1
+            group["total"] += price
+            group["minimum"] = min(group["minimum"], price)
+            group["maximum"] = max(group["maximum"], price)
+        if not groups:
+            return
+        if db.engine.dialect.name == "sqlite":
+            statement = CATEGORY_STATS_ADD_SQL.format(least="min", greatest="max")
+        else:
+            statement = CATEGORY_STATS_ADD_SQL.format(least="least", greatest="greatest")
+        db.session.execute(text(statement), list(groups.values()))
+
+    @classmethod
+    def remove(cls, category, price):
+        """ Removes the price of a Product from the statistics once its row is flushed away """
+        params = {"category": category.lower(), "price": float(price)}
+        for statement in CATEGORY_STATS_REMOVE_SQL:
+            db.session.execute(text(statement), params)
+
+    @classmethod
+    def price_range(cls):
+        """ Returns the lowest and the highest price of all Products, or (None, None) without any """
+        return db.session.query(func.min(cls.minimum), func.max(cls.maximum)).one()
+
+    @classmethod
+    def all(cls):
+        """ Returns the statistics of every category ordered by category """
+        return cls.query.order_by(cls.category).all()
+
+
 class Product(db.Model):
     """
     Class that represents a product
@@ -24,6 +245,10 @@ class Product(db.Model):
 
     logger = logging.getLogger(__name__)
     app = None
+    # Read-through cache of Product.find(), reconfigured from the app in init_db()
+    cache = LRUCache()
+    # Whether PostgreSQL full text search is available, looked up on the first search
+    search_vector = None
     ##################################################
     # Table Schema
     ##################################################
@@ -33,6 +258,9 @@ class Product(db.Model):
     description = db.Column(db.String(256), nullable=False)
     category = db.Column(db.String(63), nullable=False)
     price = db.Column(db.Float, nullable=False)
+    # bumped by every update, identifies the state of a Product in its ETag
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     ##################################################
     # INSTANCE METHODS
@@ -48,11 +276,41 @@ class Product(db.Model):
         self.logger.info("Creating %s", self.name)
         self.id = None
         db.session.add(self)
+        ChangeGeneration.bump()
+        CategoryStats.add([(self.category, self.price)])
         try:
             db.session.commit()
         except InvalidRequestError:
             db.session.rollback()
+        self.cache.invalidate(self.id)
 
+    @classmethod
+    def create_many(cls, products):
+        """
+        Creates a list of Products to the data store in a single transaction
+        """
+        cls.logger.info("Creating %d products", len(products))
+        if not products:
+            return
+        if db.engine.dialect.name == "postgresql":
+            # One multi-row INSERT ... RETURNING id instead of one INSERT per row
+            rows = [{"name": product.name, "description": product.description,
+                     "category": product.category, "price": product.price} for product in products]
+            result = db.session.execute(cls.__table__.insert().values(rows).returning(cls.__table__.c.id))
+            for product, row in zip(products, result):
+                product.id = row[0]
+        else:
+            for product in products:
+                product.id = None
+            db.session.add_all(products)
+        ChangeGeneration.bump()
+        CategoryStats.add([(product.category, product.price) for product in products])
+        try:
+            db.session.commit()
+        except InvalidRequestError:
+            db.session.rollback()
+        for product in products:
+            cls.cache.invalidate(product.id)
 
     def update(self):
         """
@@ -62,19 +320,58 @@ class Product(db.Model):
         if not self.id:
             self.logger.info("Update called with empty ID field")
             raise DataValidationError("Update called with empty ID field")
+        with db.session.no_autoflush:
+            # locked, so that concurrent updates move the statistics one after the other
+            old = db.session.query(Product.category, Product.price).filter(Product.id == self.id) \
+                .with_for_update().first()
+        self.version = Product.version + 1
+        ChangeGeneration.bump()
+        if old is not None and (old.category.lower(), float(old.price)) != (self.category.lower(), float(self.price)):
+            db.session.flush()
+            CategoryStats.remove(old.category, old.price)
+            CategoryStats.add([(self.category, self.price)])
         try:
             db.session.commit()
         except InvalidRequestError:
             db.session.rollback()
+        self.cache.invalidate(self.id)
 
     def delete(self):
-        """ Removes a Product from the data store """
+        """
+        Removes a Product from the data store
+
+        Returns False when its row was already gone, deleted by another request
+        """
         self.logger.info("Deleting %r", self.name)
-        db.session.delete(self)
+        table = self.__table__
+        statement = table.delete().where(table.c.id == self.id)
+        if self in db.session:
+            # the row is deleted with a statement that reports what it deleted, not by the unit of work
+            db.session.expunge(self)
+        if db.engine.dialect.name == "postgresql":
+            row = db.session.execute(statement.returning(table.c.category, table.c.price)).first()
+        else:
+            row = db.session.execute(select([table.c.category, table.c.price]).where(table.c.id == self.id)).first()
+            if row is not None and db.session.execute(statement).rowcount != 1:
+                row = None
+        if row is None:
+            self.logger.info("Product with id [%s] was already deleted", self.id)
+            db.session.rollback()
+            self.cache.invalidate(self.id)
+            return False
+        # the statistics follow the deleted row, which may differ from this copy
+        ChangeGeneration.bump()
+        CategoryStats.remove(row.category, row.price)
         try:
             db.session.commit()
         except InvalidRequestError:
             db.session.rollback()
+        self.cache.invalidate(self.id)
+        return True
+
+    def columns(self):
+        """ Returns the value of every mapped column of a Product """
+        return {attribute.key: getattr(self, attribute.key) for attribute in inspect(self).mapper.column_attrs}
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -115,10 +412,76 @@ class Product(db.Model):
         """ Initializes the database session """
         cls.logger.info("Initializing database")
         cls.app = app
+        cls.cache = LRUCache(app.config.get("PRODUCT_CACHE_SIZE", 1024), app.config.get("PRODUCT_CACHE_TTL", 60.0))
+        cls.search_vector = None
         # This is where we initialize SQLAlchemy from the Flask app
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
         db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # every request then runs in its own application context, whose
+        # teardown removes the session of its thread
+        with app.app_context():
+            version = SchemaVersion.current(db.engine) if app.config.get("DATABASE_SCHEMA_CHECK", True) else None
+            if version is not None and version >= SCHEMA_VERSION:
+                # a newer version is left alone for the workers of the next release
+                cls.logger.info("Schema is at version %d", version)
+                return
+            db.create_all()  # make our sqlalchemy tables
+            # create_all() skips tables that already exist, so bring them up to date
+            cls.upgrade_schema(db.engine)
+            SchemaVersion.stamp(db.engine, SCHEMA_VERSION)
+
+    @classmethod
+    def upgrade_schema(cls, connection):
+        """ Creates the columns, indexes and search tables that create_all() does not """
+        cls.logger.info("Upgrading schema")
+        if connection.dialect.name == "postgresql":
+            for statement in POSTGRES_UPGRADE_DDL:
+                connection.execute(statement)
+        for statement in PRODUCT_INDEX_DDL:
+            connection.execute(statement)
+        if connection.dialect.has_table(connection, "category_stats"):
+            connection.execute(CATEGORY_STATS_BACKFILL_SQL)
+        if connection.dialect.name == "sqlite":
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'").first()
+            for statement in SQLITE_FULL_TEXT_DDL:
+                connection.execute(statement)
+            if not exists:
+                # index the rows that were there before the FTS table
+                connection.execute("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+            return
+        if connection.dialect.name != "postgresql":
+            return
+        cls._optional_ddl(connection, ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + TRIGRAM_INDEX_DDL,
+                          "pg_trgm is not available, substring queries will not be indexed")
+        # generated columns need PostgreSQL 12
+        cls._optional_ddl(connection, POSTGRES_FULL_TEXT_DDL,
+                          "Full text search is not available, searches will match substrings")
+        cls.search_vector = None
+
+    @classmethod
+    def _optional_ddl(cls, connection, statements, warning):
+        """ Runs the DDL of an optional feature, returns False with a warning if the database does not support it """
+        # a failed statement must not abort the transaction create_all() runs the DDL in
+        savepoint = connection.begin_nested() if isinstance(connection, Connection) and connection.in_transaction() else None
+        try:
+            for statement in statements:
+                connection.execute(statement)
+        except DBAPIError as error:
+            if savepoint is not None:
+                savepoint.rollback()
+            cls.logger.warning("%s: %s", warning, error)
+            return False
+        if savepoint is not None:
+            savepoint.commit()
+        return True
+
+    @classmethod
+    def has_search_vector(cls):
+        """ Returns whether the product table has the search_vector column of PostgreSQL full text search """
+        if cls.search_vector is None:
+            columns = inspect(db.engine).get_columns(cls.__tablename__)
+            cls.search_vector = any(column["name"] == "search_vector" for column in columns)
+        return cls.search_vector
 
     @classmethod
     def all(cls):
@@ -127,15 +490,214 @@ class Product(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, product_id: int):
+    def find(cls, product_id: int, cached: bool = True):
         """Finds a Product by its ID
         :param product_id: the id of the product to find
         :type product_id: int
+        :param cached: whether the lookup may be answered from the cache of this worker,
+            which can be behind the writes of other workers; writes must pass False
+        :type cached: bool
         :return: an instance with the product_id, or None if not found
         :rtype: Product
         """
         cls.logger.info("Processing lookup for id %s ...", product_id)
-        return cls.query.get(product_id)
+        if not cached:
+            return cls.query.get(product_id)
+        # a client that just wrote, maybe through another worker, must see its write
+        columns = NOT_CACHED if reads_own_writes() else cls.cache.get(product_id, NOT_CACHED)
+        if columns is NOT_CACHED:
+            product = cls.query.get(product_id)
+            # a lagging replica could put back a row that a write on this
+            # worker just invalidated, so only the primary fills the cache
+            if not (reads_replica() and replica_binds(db.get_app().config)):
+                # cache misses as None so unknown ids do not hit the database either
+                cls.cache.set(product_id, product.columns() if product else None)
+            return product
+        if columns is None:
+            return None
+        # attach a copy of the cached row to the session without loading it
+        product = cls(**columns)
+        make_transient_to_detached(product)
+        return db.session.merge(product, load=False)
+
+    @classmethod
+    def find_many(cls, product_ids: list):
+        """Finds the Products with any of the given IDs in one query
+        :param product_ids: the ids of the products to find
+        :type product_ids: list
+        :return: the products that were found
+        :rtype: list
+        """
+        cls.logger.info("Processing lookup for %d ids ...", len(product_ids))
+        if not product_ids:
+            return []
+        return cls.query.filter(cls.id.in_(product_ids)).all()
+
+    @classmethod
+    def search(cls, terms: str, limit: int):
+        """Returns the Products that best match a full text search
+        :param terms: the words to search for in the name and description
+        :type terms: str
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :return: the matching Products, most relevant first
+        :rtype: list
+        """
+        cls.logger.info("Processing full text search for %s ...", terms)
+        dialect = db.engine.dialect.name
+        if dialect == "postgresql" and cls.has_search_vector():
+            statement = POSTGRES_SEARCH_SQL
+        elif dialect == "sqlite":
+            # quote every word so FTS5 does not parse the terms as query syntax
+            words = re.findall(r"\w+", terms)
+            if not words:
+                return []
+            terms = " ".join('"{}"'.format(word) for word in words)
+            statement = SQLITE_SEARCH_SQL
+        else:
+            # without full text search, match the terms as a substring
+            return cls.query.filter(or_(func.lower(cls.name).contains(func.lower(terms)),
+                                        func.lower(cls.description).contains(func.lower(terms)))).order_by(cls.id).limit(limit).all()
+        return cls.query.from_statement(text(statement)).params(terms=terms, limit=limit).all()
+
+    @classmethod
+    def find_by(cls, name: str = None, category: str = None, description: str = None,
+                minimum: float = None, maximum: float = None, after_id: int = None, limit: int = None,
+                fields: tuple = None, yield_per: int = None, sort: tuple = None, after: tuple = None):
+        """Returns the Products matching every one of the given criteria
+        :param name: text the name of the Products must contain
+        :type name: str
+        :param category: the category of the Products, in any case
+        :type category: str
+        :param description: text the description of the Products must contain
+        :type description: str
+        :param minimum: the lowest price of the Products
+        :type minimum: float
+        :param maximum: the highest price of the Products
+        :type maximum: float
+        :param after_id: only return Products with an id greater than this one, or after it in the sort
+        :type after_id: int
+        :param limit: the maximum number of Products to return, ordered by id unless sorted
+        :type limit: int
+        :param fields: the names of the only columns to return, as rows of plain values instead of Products
+        :type fields: tuple
+        :param yield_per: stream the Products ordered by id, fetching this many rows at a time
+        :type yield_per: int
+        :param sort: the fields to order the Products by, descending if prefixed with "-", ties are broken by id
+        :type sort: tuple
+        :param after: with after_id, the values of the sort fields of the Product to continue after
+        :type after: tuple
+        :return: a collection of the matching Products, or of their rows if fields are given
+        :rtype: Result
+        """
+        params = {"name": name, "category": category, "description": description,
+                  "minimum": minimum, "maximum": maximum, "after_id": after_id, "limit": limit}
+        params = {key: value for key, value in params.items() if value is not None}
+        cls.logger.info("Processing query for %s sorted by %s ...", params, sort)
+        # The baked query is keyed by the lambdas that make it up, so the SQL
+        # of each combination of criteria is built and compiled only once
+        query = bakery(lambda session: session.query(cls))
+        if fields is not None:
+            # named tuples of the columns skip building Products and the identity map,
+            # the fields are part of the cache key since the lambda is the same for all
+            query.add_criteria(lambda q: q.with_entities(*[cls.__table__.c[field] for field in fields]), *fields)
+        cls._add_filters(query, params)
+        if sort:
+            if after_id is not None:
+                query.add_criteria(lambda q: q.filter(cls._after(sort)), *sort)
+                params.update(("after_{}".format(index), value) for index, value in enumerate(after))
+            query.add_criteria(lambda q: q.order_by(*cls._order(sort)), *sort)
+        elif after_id is not None:
+            query += lambda q: q.filter(cls.id > bindparam("after_id"))
+        if limit is not None:
+            if not sort:
+                query += lambda q: q.order_by(cls.id)
+            query += lambda q: q.limit(bindparam("limit"))
+        if yield_per is not None:
+            # yield_per() must be baked in, it has no effect as a post criteria
+            query.add_criteria(lambda q: q.order_by(cls.id).yield_per(yield_per), yield_per)
+        return query(db.session()).params(**params)
+
+    @classmethod
+    def _add_filters(cls, query, params):
+        """ Adds the filters of find_by() that have a value in params to a baked query """
+        if "name" in params:
+            query += lambda q: q.filter(func.lower(cls.name).contains(func.lower(bindparam("name"))))
+        if "category" in params:
+            query += lambda q: q.filter(func.lower(cls.category) == func.lower(bindparam("category")))
+        if "description" in params:
+            query += lambda q: q.filter(func.lower(cls.description).contains(func.lower(bindparam("description"))))
+        if "minimum" in params:
+            query += lambda q: q.filter(cls.price >= bindparam("minimum"))
+        if "maximum" in params:
+            query += lambda q: q.filter(cls.price <= bindparam("maximum"))
+
+    @classmethod
+    def _sort_keys(cls, sort):
+        """ Returns the columns of a sort and whether each is descending, ending with the id """
+        keys = [(cls.__table__.c[field.lstrip("-")], field.startswith("-")) for field in sort]
+        if "id" not in sort and "-id" not in sort:
+            # the id follows the direction of the last field so a single index is walked one way
+            keys.append((cls.id, keys[-1][1]))
+        return keys
+
+    @classmethod
+    def _order(cls, sort):
+        """ Returns the ORDER BY clauses of a sort """
+        return [column.desc() if descending else column.asc() for column, descending in cls._sort_keys(sort)]
+
+    @classmethod
+    def _after(cls, sort):
+        """ Returns the condition of the rows after the after_N and after_id parameters in a sort """
+        keys = cls._sort_keys(sort)
+        values = [bindparam("after_id") if column is cls.id else bindparam("after_{}".format(index))
+                  for index, (column, _) in enumerate(keys)]
+        if len({descending for _, descending in keys}) == 1:
+            # a row value comparison is a range of a matching index
+            row, after = tuple_(*[column for column, _ in keys]), tuple_(*values)
+            return row < after if keys[0][1] else row > after
+        return or_(*[
+            and_(*[column == value for (column, _), value in zip(keys[:index], values[:index])],
+                 column < values[index] if descending else column > values[index])
+            for index, (column, descending) in enumerate(keys)
+        ])
+
+    @classmethod
+    def facets(cls, width: float, name: str = None, category: str = None, description: str = None,
+               minimum: float = None, maximum: float = None):
+        """Counts the Products matching the criteria of find_by() by category and price bucket in one query
+        :param width: the width of the price buckets
+        :type width: float
+        :return: (lower case category, bucket, count) rows, where bucket is the price divided by width rounded down
+        :rtype: list
+        """
+        params = {"name": name, "category": category, "description": description,
+                  "minimum": minimum, "maximum": maximum}
+        params = {key: value for key, value in params.items() if value is not None}
+        cls.logger.info("Processing facets of %s ...", params)
+        dialect = db.engine.dialect.name
+        quotient = cls.price / bindparam("width", type_=Float)
+        # prices are never negative, so truncating rounds down where floor() is missing
+        bucket = cast(quotient, Integer) if dialect == "sqlite" else cast(func.floor(quotient), Integer)
+        query = bakery(lambda session: session.query(cls))
+        query.add_criteria(lambda q: q.with_entities(func.lower(cls.category), bucket, func.count()), dialect)
+        cls._add_filters(query, params)
+        # the bucket has a bind parameter, so group by position to match the select list
+        query += lambda q: q.group_by(literal_column("1"), literal_column("2"))
+        return query(db.session()).params(width=width, **params).all()
+
+    @classmethod
+    def export(cls, chunk_size: int, **criteria):
+        """Streams the Products matching the criteria of find_by() ordered by id
+        :param chunk_size: the number of rows fetched from the database at a time
+        :type chunk_size: int
+        :return: an iterator over the matching Products, or their rows if fields are given
+        :rtype: iterator
+        """
+        cls.logger.info("Processing export of %s ...", criteria)
+        # yield_per() streams the rows, through a named server side cursor on PostgreSQL,
+        # instead of fetching them all before the first one is returned
+        return iter(cls.find_by(yield_per=chunk_size, **criteria))
 
     @classmethod
     def find_by_name(cls, name: str):
@@ -145,8 +707,7 @@ class Product(db.Model):
         :return: a collection of Products with that name
         :rtype: list
         """
-        cls.logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)))
+        return cls.find_by(name=name).all()
 
     @classmethod
     def find_by_category(cls, category: str):
@@ -156,8 +717,7 @@ class Product(db.Model):
         :return: a collection of Products in that category
         :rtype: list
         """
-        cls.logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(func.lower(cls.category) == func.lower(category))
+        return cls.find_by(category=category).all()
 
     @classmethod
     def find_by_description(cls, description: str):
@@ -167,8 +727,7 @@ class Product(db.Model):
         :return: a collection of Products match the description
         :rtype: list
         """
-        cls.logger.info("Processing description query for %s ...", description)
-        return cls.query.filter(func.lower(cls.description).contains(func.lower(description)))
+        return cls.find_by(description=description).all()
 
     @classmethod
     def query_by_price(cls, minimum: float, maximum: float):
@@ -178,82 +737,255 @@ class Product(db.Model):
         :return: a collection of Products match the price range
         :rtype: list
         """
-        cls.logger.info("Searching for all products within the price range of minimum to maximum")
-        return cls.query.filter(cls.price.between(minimum, maximum))
+        return cls.find_by(minimum=minimum, maximum=maximum).all()
 
-    @classmethod
-    def find_by_name_category(cls, name: str, category: str):
-        """Query Products by the given name and category
-        """
-        cls.logger.info("Processing name and category query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.category) == func.lower(category))
+class Purchase(db.Model):
+    """
+    Class that represents a purchase in the outbox
 
-    @classmethod
-    def find_by_name_description(cls, name: str, description: str):
-        """Query Products by the given name and description
-        """
-        cls.logger.info("Processing name and description query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.description).contains(func.lower(description)))
+    An asynchronous purchase is stored here in the request that makes it, and
+    is sent to the shopcart service later by the dispatcher in service.outbox
+    """
 
-    @classmethod
-    def find_by_name_price(cls, name: str, minimum: float, maximum: float):
-        """Query Products by the given name and price
+    logger = logging.getLogger(__name__)
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+    ##################################################
+    # Table Schema
+    ##################################################
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(63), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING, index=True)
+    # the HTTP status and message the purchase would have been answered with
+    code = db.Column(db.Integer)
+    message = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return "<<Purchase> id=[%s] product=[%s] user=[%s] %s>" % (self.id, self.product_id, self.user_id, self.status)
+
+    def create(self):
+        """
+        Adds a Purchase to the outbox
         """
-        cls.logger.info("Processing name and price query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), cls.price.between(minimum, maximum))
+        self.logger.info("Queueing purchase of product %s by user %s", self.product_id, self.user_id)
+        self.id = None
+        db.session.add(self)
+        db.session.commit()
+
+    def item(self):
+        """ Returns the shopcart item of the Purchase """
+        return {"sku": self.product_id, "amount": self.amount, "name": self.name, "price": self.price}
+
+    def serialize(self):
+        """ Serializes a Purchase into a dictionary """
+        return {
+            "id": self.id,
+            "product_id": self.product_id,
+            "user_id": self.user_id,
+            "amount": self.amount,
+            "status": self.status,
+            "code": self.code,
+            "message": self.message,
+            "attempts": self.attempts,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat()
+        }
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
 
     @classmethod
-    def find_by_category_description(cls, category: str, description: str):
-        """Query Products by the given category and description
+    def find(cls, purchase_id: int):
+        """Finds a Purchase by its ID
+        :param purchase_id: the id of the purchase to find
+        :type purchase_id: int
+        :return: an instance with the purchase_id, or None if not found
+        :rtype: Purchase
         """
-        cls.logger.info("Processing category and description query")
-        return cls.query.filter(func.lower(cls.category) == func.lower(category), func.lower(cls.description).contains(func.lower(description)))
+        cls.logger.info("Processing lookup for purchase %s ...", purchase_id)
+        return cls.query.get(purchase_id)
 
     @classmethod
-    def find_by_category_price(cls, category: str, minimum: float, maximum: float):
-        """Query Products by the given category and price
+    def find_due(cls, limit: int, now: datetime):
+        """Returns the pending Purchases of the users whose oldest pending Purchase is due
+        :param limit: the maximum number of purchases to return
+        :type limit: int
+        :param now: the time the oldest pending purchase of a user must be due by
+        :type now: datetime
+        :return: the pending purchases of those users ordered by id
+        :rtype: list
         """
-        cls.logger.info("Processing category and price query")
-        return cls.query.filter(func.lower(cls.category) == func.lower(category), cls.price.between(minimum, maximum))
+        # the oldest pending purchase of every user, which the later ones wait behind
+        heads = db.session.query(func.min(cls.id).label("id")).filter(cls.status == cls.PENDING) \
+            .group_by(cls.user_id).subquery()
+        due = db.session.query(cls.user_id).join(heads, cls.id == heads.c.id).filter(cls.next_attempt_at <= now)
+        return cls.query.filter(cls.status == cls.PENDING, cls.user_id.in_(due)).order_by(cls.id).limit(limit).all()
 
-    @classmethod
-    def find_by_description_price(cls, description: str, minimum: float, maximum: float):
-        """Query Products by the given description and price
+
+class ImportJob(db.Model):
+    """
+    Class that represents a bulk import of Products
+
+    The uploaded file is loaded in chunks by the import worker in
+    service.imports, and the job keeps the progress and the errors of the
+    lines that were rejected as of the last chunk it committed
+    """
+
+    logger = logging.getLogger(__name__)
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    ##################################################
+    # Table Schema
+    ##################################################
+
+    id = db.Column(db.Integer, primary_key=True)
+    format = db.Column(db.String(16), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    # JSON list of the first rejected lines with the reason of each
+    errors = db.Column(db.Text, nullable=False, default="[]")
+    message = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return "<<ImportJob> id=[%s] %s %s>" % (self.id, self.format, self.status)
+
+    def create(self):
         """
-        cls.logger.info("Processing description and price query")
-        return cls.query.filter(func.lower(cls.description).contains(func.lower(description)), cls.price.between(minimum, maximum))
+        Adds an ImportJob to the data store
+        """
+        self.logger.info("Creating %s import", self.format)
+        self.id = None
+        db.session.add(self)
+        db.session.commit()
+
+    def serialize(self):
+        """ Serializes an ImportJob into a dictionary """
+        return {
+            "id": self.id,
+            "format": self.format,
+            "status": self.status,
+            "lines": self.lines,
+            "imported": self.imported,
+            "rejected": self.rejected,
+            "errors": json.loads(self.errors),
+            "message": self.message,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat()
+        }
 
     @classmethod
-    def find_by_name_category_description(cls, name: str, category: str, description: str):
-        """Query Products by the given name, category and description
+    def find(cls, job_id: int):
+        """Finds an ImportJob by its ID
+        :param job_id: the id of the import job to find
+        :type job_id: int
+        :return: an instance with the job_id, or None if not found
+        :rtype: ImportJob
         """
-        cls.logger.info("Processing name, category and description query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.category) == func.lower(category), func.lower(cls.description).contains(func.lower(description)))
+        cls.logger.info("Processing lookup for import %s ...", job_id)
+        return cls.query.get(job_id)
 
     @classmethod
-    def find_by_name_category_price(cls, name: str, category: str, minimum: float, maximum: float):
-        """Query Products by the given name, category and price
+    def claim(cls, stale_before: datetime, candidates: int = 10):
+        """Claims the oldest pending ImportJob, or a running one whose worker stopped committing
+        :param stale_before: running jobs last updated before this time are taken over
+        :type stale_before: datetime
+        :param candidates: the number of jobs to try when other workers claim them first
+        :type candidates: int
+        :return: the claimed job marked as running, or None if there is none to run
+        :rtype: ImportJob
         """
-        cls.logger.info("Processing name, category and price query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.category) == func.lower(category), cls.price.between(minimum, maximum))
+        runnable = or_(cls.status == cls.PENDING, and_(cls.status == cls.RUNNING, cls.updated_at < stale_before))
+        jobs = [(job.id, job.status, job.updated_at)
+                for job in cls.query.filter(runnable).order_by(cls.id).limit(candidates)]
+        for job_id, status, updated_at in jobs:
+            # only one worker updates the job from the state it read
+            claimed = cls.query.filter(cls.id == job_id, cls.status == status, cls.updated_at == updated_at) \
+                .update({"status": cls.RUNNING, "updated_at": datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                cls.logger.info("Claimed %s import %s", status, job_id)
+                return cls.query.get(job_id)
+        return None
+
+
+class ImportUpload(db.Model):
+    """
+    Class that represents a piece of an upload waiting to be imported
+
+    Uploads are kept in the database instead of on the disk of the web
+    worker that received them, so that any import worker can load them
+    """
+
+    __tablename__ = "import_upload"
+
+    job_id = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.LargeBinary, nullable=False)
 
     @classmethod
-    def find_by_name_description_price(cls, name: str, description: str, minimum: float, maximum: float):
-        """Query Products by the given name, description and price
+    def store(cls, job_id: int, stream, chunk_size: int = 1 << 20):
+        """Stores an upload in the current transaction without holding it in memory
+        :param job_id: the id of the import job of the upload
+        :type job_id: int
+        :param stream: the binary stream of the upload
+        :param chunk_size: the number of bytes stored in each piece
+        :type chunk_size: int
         """
-        cls.logger.info("Processing name, description and price query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.description).contains(func.lower(description)), cls.price.between(minimum, maximum))
+        for number, data in enumerate(iter(lambda: stream.read(chunk_size), b"")):
+            db.session.execute(cls.__table__.insert(), {"job_id": job_id, "number": number, "data": data})
 
     @classmethod
-    def find_by_category_description_price(cls, category: str, description: str, minimum: float, maximum: float):
-        """Query Products by the given category, description and price
+    def read(cls, job_id: int):
+        """Yields the pieces of an upload in order, one query each, so that it can be read across commits
+        :param job_id: the id of the import job of the upload
+        :type job_id: int
         """
-        cls.logger.info("Processing category, description and price query")
-        return cls.query.filter(func.lower(cls.category) == func.lower(category), func.lower(cls.description).contains(func.lower(description)), cls.price.between(minimum, maximum))
+        for number in itertools.count():
+            data = db.session.query(cls.data).filter(cls.job_id == job_id, cls.number == number).scalar()
+            if data is None:
+                return
+            yield data
 
     @classmethod
-    def find_by_name_category_description_price(cls, name: str, category: str, description: str, minimum: float, maximum: float):
-        """Query Products by the given name, category, description and price
+    def remove(cls, job_id: int):
+        """Deletes an upload in the current transaction
+        :param job_id: the id of the import job of the upload
+        :type job_id: int
         """
-        cls.logger.info("Processing name, category, description and price query")
-        return cls.query.filter(func.lower(cls.name).contains(func.lower(name)), func.lower(cls.category) == func.lower(category), func.lower(cls.description).contains(func.lower(description)), cls.price.between(minimum, maximum))
+        cls.query.filter(cls.job_id == job_id).delete(synchronize_session=False)
+
+
+@event.listens_for(Product.__table__, "after_create")
+def create_product_indexes(_target, connection, **_kwargs):
+    """ Creates the indexes and search tables whenever the product table is created """
+    Product.upgrade_schema(connection)
+
+
+@event.listens_for(Product.__table__, "before_drop")
+def drop_product_search_table(_target, connection, **_kwargs):
+    """ Drops the SQLite full text search table along with the product table """
+    if connection.dialect.name == "sqlite":
+        connection.execute("DROP TABLE IF EXISTS product_fts")
+
+
+@event.listens_for(ChangeGeneration.__table__, "after_create")
+def create_change_generation(target, connection, **_kwargs):
+    """ Inserts the single row of the change generation table """
+    connection.execute(target.insert().values(id=1, value=0))
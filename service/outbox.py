@@ -0,0 +1,118 @@
+"""
+Purchase Outbox Dispatcher
+
+Sends the purchases queued in the outbox table to the shopcart service.
+The purchases of a user are sent one at a time in the order they were
+made, while the purchases of different users are sent in parallel. A
+purchase that cannot reach the shopcart service is retried with
+exponential backoff and fails for good after a bounded number of attempts.
+Calls that fail while the circuit to the shopcart service is open are not
+counted as attempts, so a long outage only delays the purchases.
+
+Run a single dispatcher next to the web workers with:
+
+    python -m service.outbox
+"""
+import time
+import logging
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from service.models import db, Purchase
+from service import shopcart
+
+logger = logging.getLogger(__name__)
+
+HEADER = {'Content-Type': 'application/json'}
+
+
+def send_user_purchases(url, user_id, items):
+    """
+    Sends the purchases of one user in order
+
+    Returns a (purchase id, code, message, counted) outcome for every purchase
+    that was tried. Sending stops at the first purchase that fails, whose code
+    is None, so that the later purchases of the user wait behind it. A failure
+    is not counted as an attempt while the circuit to the service is open
+    """
+    outcomes = []
+    for purchase_id, item in items:
+        try:
+            code, message = shopcart.add_purchase(url, HEADER, user_id, item)
+        except requests.RequestException as error:
+            counted = shopcart.breaker.state == shopcart.CircuitBreaker.CLOSED
+            outcomes.append((purchase_id, None, str(error)[:255], counted))
+            break
+        except Exception as error:  # pylint: disable=broad-except
+            # an unexpected answer fails this purchase alone, not the batch of every user
+            logger.exception("Sending purchase %s failed", purchase_id)
+            outcomes.append((purchase_id, None, str(error)[:255], True))
+            break
+        outcomes.append((purchase_id, code, message, True))
+    return outcomes
+
+
+def dispatch(url, batch_size=100, max_attempts=5, backoff=1.0, workers=4):
+    """ Sends a batch of pending purchases and returns how many of them were settled """
+    by_user = OrderedDict()
+    # the later purchases of a user wait until the oldest one is due again
+    for purchase in Purchase.find_due(batch_size, datetime.utcnow()):
+        by_user.setdefault(purchase.user_id, []).append(purchase)
+    if not by_user:
+        return 0
+    jobs = [(user_id, [(purchase.id, purchase.item()) for purchase in purchases]) for user_id, purchases in by_user.items()]
+    purchases = {purchase.id: purchase for pending in by_user.values() for purchase in pending}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda job: send_user_purchases(url, *job), jobs))
+
+    settled = 0
+    for outcomes in results:
+        for purchase_id, code, message, counted in outcomes:
+            purchase = purchases[purchase_id]
+            purchase.message = message
+            if not counted:
+                # the circuit is open, try again once it may have closed
+                purchase.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+                continue
+            purchase.attempts += 1
+            if code is None and purchase.attempts < max_attempts:
+                delay = backoff * 2 ** (purchase.attempts - 1)
+                purchase.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                continue
+            purchase.code = 503 if code is None else code
+            purchase.status = Purchase.DONE if code == 200 else Purchase.FAILED
+            settled += 1
+    db.session.commit()
+    logger.info("Settled %d of %d pending purchases", settled, len(purchases))
+    return settled
+
+
+def run(app):
+    """ Dispatches the outbox until interrupted """
+    config = app.config
+    shopcart.configure(config)
+    logger.info("Dispatching purchases to %s", config["SHOPCART_ENDPOINT"])
+    while True:
+        # leaving the application context removes the session of the batch
+        with app.app_context():
+            try:
+                settled = dispatch(
+                    config["SHOPCART_ENDPOINT"],
+                    batch_size=config["OUTBOX_BATCH_SIZE"],
+                    max_attempts=config["OUTBOX_MAX_ATTEMPTS"],
+                    backoff=config["OUTBOX_BACKOFF"],
+                    workers=config["OUTBOX_WORKERS"]
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Dispatching purchases failed: %s", error)
+                db.session.rollback()
+                settled = 0
+        if not settled:
+            time.sleep(config["OUTBOX_INTERVAL"])
+
+
+if __name__ == "__main__":
+    from service import app as service_app
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")
+    run(service_app)
@@ -0,0 +1,64 @@
+"""
+Database connection pool
+
+Builds the options of the database engine from the configuration and
+keeps the statistics of its connection pool
+"""
+import time
+import threading
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that measures how long checkouts wait for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+
+def engine_options(config):
+    """ Returns the SQLAlchemy engine options for the database in the configuration """
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        # Flask-SQLAlchemy picks the pool that fits SQLite
+        return {}
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DATABASE_POOL_SIZE"],
+        "max_overflow": config["DATABASE_MAX_OVERFLOW"],
+        "pool_timeout": config["DATABASE_POOL_TIMEOUT"],
+        "pool_recycle": config["DATABASE_POOL_RECYCLE"],
+        "pool_pre_ping": config["DATABASE_POOL_PRE_PING"]
+    }
+
+
+def pool_status(engine):
+    """ Returns the live statistics of the connection pool of an engine """
+    pool = engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return {"class": type(pool).__name__}
+    return {
+        "class": type(pool).__name__,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": pool._max_overflow,  # pylint: disable=protected-access
+        "checkouts": pool.checkouts,
+        "wait_time": round(pool.wait_time, 6),
+        "max_wait": round(pool.max_wait, 6)
+    }
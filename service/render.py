@@ -0,0 +1,82 @@
+"""
+JSON Rendering
+
+Encodes Products, or rows of some of their columns, straight to the bytes
+of a response body in the shape of product_model, skipping the dictionaries
+of Product.serialize(), the field walk of marshal() and Flask's JSON
+encoder. Uses orjson when it is installed and falls back to the json module
+of the standard library
+"""
+import io
+import csv
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# The fields of product_model in their order, and the conversions of the
+# columns whose JSON type differs from the one the database returns
+PRODUCT_FIELDS = ("name", "category", "description", "price", "id")
+FORMATS = {"price": float, "id": str}
+
+
+def dumps(data):
+    """ Encodes data into JSON bytes that end with a newline """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def product_row(product):
+    """ Returns a Product with the fields and types of product_model """
+    return {
+        "name": product.name,
+        "category": product.category,
+        "description": product.description,
+        "price": float(product.price),
+        "id": str(product.id)
+    }
+
+
+def render_products(products):
+    """ Encodes a list of Products into the JSON bytes of a response body """
+    return dumps([product_row(product) for product in products])
+
+
+def render_rows(rows, fields):
+    """ Encodes rows of column values, in the order of fields, into the JSON bytes of a response body """
+    formats = [(field, FORMATS.get(field)) for field in fields]
+    return dumps([
+        {field: value if convert is None else convert(value) for (field, convert), value in zip(formats, row)}
+        for row in rows
+    ])
+
+
+def stream_ndjson(rows, fields, batch=1000):
+    """ Yields rows of column values as lines of JSON objects, a batch of lines at a time """
+    formats = [(field, FORMATS.get(field)) for field in fields]
+    lines = []
+    for row in rows:
+        lines.append(dumps({field: value if convert is None else convert(value) for (field, convert), value in zip(formats, row)}))
+        if len(lines) >= batch:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+
+
+def stream_csv(rows, fields, batch=1000):
+    """ Yields a header line and rows of column values as CSV, a batch of lines at a time """
+    data = io.StringIO()
+    writer = csv.writer(data)
+    writer.writerow(fields)
+    width = len(fields)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row[:width])
+        if count % batch == 0:
+            yield data.getvalue().encode("utf-8")
+            data.seek(0)
+            data.truncate()
+    yield data.getvalue().encode("utf-8")
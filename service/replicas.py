@@ -0,0 +1,89 @@
+"""
+Read replicas
+
+Sends the queries of the catalog reads to the read replicas configured as
+the replica_* binds of SQLALCHEMY_BINDS, and every other query to the
+primary. A client that has just written is pinned to the primary with a
+cookie for a short window, so that it always reads its own writes even
+while the replicas lag behind
+"""
+import math
+import time
+import random
+import functools
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+REPLICA_BIND_PREFIX = "replica"
+# Holds the time until which a client reads from the primary
+PRIMARY_COOKIE = "read_primary_until"
+# Marks the requests whose queries go to a replica, in the WSGI environment
+# since the application context, and g, can outlive a request
+READ_REPLICA = "service.read_replica"
+# Holds the replica bind a request reads from, so that all of its queries
+# see the same point of the replication stream
+REPLICA_BIND = "service.replica_bind"
+
+
+def replica_binds(config):
+    """ Returns the names of the read replica binds in the configuration """
+    return sorted(bind for bind in config.get("SQLALCHEMY_BINDS") or {} if bind.startswith(REPLICA_BIND_PREFIX))
+
+
+class RoutingSession(SignallingSession):
+    """ A session that sends the queries of a replica read to one read replica, picked at random per request """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and request.environ.get(READ_REPLICA) and not self._flushing:
+            binds = replica_binds(self.app.config)
+            if binds:
+                bind = request.environ.get(REPLICA_BIND)
+                if bind not in binds:
+                    bind = request.environ[REPLICA_BIND] = random.choice(binds)
+                return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ A Flask-SQLAlchemy whose sessions route replica reads to the read replicas """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def pinned():
+    """ Returns whether the client of the current request wrote within its read-your-writes window """
+    if not has_request_context():
+        return False
+    try:
+        until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def reads_replica():
+    """ Returns whether the queries of the current request go to a read replica when there are any """
+    return has_request_context() and bool(request.environ.get(READ_REPLICA))
+
+
+def reads_own_writes():
+    """ Returns whether the current request must see the writes of its client, past any cache """
+    return has_request_context() and request.environ.get(READ_REPLICA) is False
+
+
+def pin(response, window):
+    """ Makes the client of a response read from the primary for the next window seconds """
+    response.set_cookie(PRIMARY_COOKIE, "{:.3f}".format(time.time() + window),
+                        max_age=int(math.ceil(window)), httponly=True)
+    return response
+
+
+def replica_read(function):
+    """ Decorates a view whose queries may be sent to a read replica, unless its client is pinned """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        request.environ[READ_REPLICA] = not pinned()
+        return function(*args, **kwargs)
+    return wrapper
@@ -4,24 +4,46 @@ My Service
 Describe what your service does here
 """
 
-import os
-#import sys
+import sys
+import json
+import math
+import base64
+import hashlib
+import binascii
 #import logging
 #import json
-import requests
-from flask import jsonify, request, make_response, abort, render_template
+from flask import jsonify, request, make_response, abort, render_template, Response, stream_with_context
+from werkzeug.urls import url_encode
 from flask_api import status  # HTTP Status Codes
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 #from flask_sqlalchemy import SQLAlchemy
-from flask_restplus import Api, Resource, fields, reqparse
-from service.models import Product, DataValidationError
+from flask_restplus import Api, Resource, fields, reqparse, marshal
+from service.models import db, Product, Purchase, ImportJob, CategoryStats, ChangeGeneration, DataValidationError
+from service.cache import LRUCache
+from service.pool import pool_status
+from service.replicas import replica_binds, replica_read, pin
+from service.render import render_products, render_rows, stream_csv, stream_ndjson, PRODUCT_FIELDS
+from service import imports
 
 # Import Flask application
 from . import app
 
-SHOPCART_ENDPOINT = os.getenv('SHOPCART_ENDPOINT', 'https://nyu-shopcart-service-f20.us-south.cf.appdomain.cloud/api/shopcarts')
+SHOPCART_ENDPOINT = app.config['SHOPCART_ENDPOINT']
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+MAX_BATCH_SIZE = 1000
+MAX_PURCHASE_ITEMS = 100
+DEFAULT_SEARCH_LIMIT = 20
+DEFAULT_PRICE_BUCKET_WIDTH = 100.0
+MIN_PRICE_BUCKET_WIDTH = 0.01
+MAX_PRICE_BUCKETS = 10000
+# Buckets are computed as integers, which are 32 bits on PostgreSQL
+MAX_PRICE_BUCKET = 2 ** 31 - 1
+
+# Encoded responses of the product list keyed by change generation and query
+result_cache = LRUCache(app.config.get('RESULT_CACHE_SIZE', 1024), app.config.get('RESULT_CACHE_TTL', 60.0))
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -62,6 +84,18 @@ product_model = api.model('Product', {
 })
 
 
+batch_error_model = api.model('BatchError', {
+    'index': fields.Integer(description='The position of the rejected Product in the request body'),
+    'message': fields.String(description='The reason the Product was rejected')
+})
+
+batch_result_model = api.model('BatchResult', {
+    'created': fields.List(fields.Nested(product_model),
+                           description='The Products that were created'),
+    'errors': fields.List(fields.Nested(batch_error_model),
+                          description='The Products that were rejected')
+})
+
 purchase_model = api.model('Purchase', {
     'id': fields.Integer(required=True,
                         description='The id of the Product'),
@@ -71,6 +105,93 @@ purchase_model = api.model('Purchase', {
                              description='The amount of the Product')
 })
 
+import_error_model = api.model('ImportError', {
+    'line': fields.Integer(description='The line of the upload that was rejected'),
+    'message': fields.String(description='The reason the line was rejected')
+})
+
+import_job_model = api.model('ImportJob', {
+    'id': fields.Integer(readOnly=True,
+                         description='The unique id of the import'),
+    'format': fields.String(description='csv or ndjson'),
+    'status': fields.String(description='pending, running, done or failed'),
+    'lines': fields.Integer(description='The number of lines read so far'),
+    'imported': fields.Integer(description='The number of Products imported so far'),
+    'rejected': fields.Integer(description='The number of lines rejected so far'),
+    'errors': fields.List(fields.Nested(import_error_model),
+                          description='The first rejected lines, as of the last chunk that was loaded'),
+    'message': fields.String(description='Why the import failed'),
+    'created_at': fields.String(description='When the import was uploaded'),
+    'updated_at': fields.String(description='When the progress was last updated')
+})
+
+purchase_item_model = api.model('PurchaseItem', {
+    'id': fields.Integer(required=True,
+                         description='The id of the Product'),
+    'amount': fields.Integer(required=True,
+                             description='The amount of the Product')
+})
+
+purchase_batch_model = api.model('PurchaseBatch', {
+    'user_id': fields.Integer(required=True,
+                              description='The user id of the person purchasing the Products'),
+    'items': fields.List(fields.Nested(purchase_item_model), required=True,
+                         description='The Products to add to the shopping cart')
+})
+
+purchase_item_result_model = api.model('PurchaseItemResult', {
+    'index': fields.Integer(description='The position of the item in the request body'),
+    'id': fields.Raw(description='The id of the Product'),
+    'code': fields.Integer(description='The status a single purchase of the item would have been answered with'),
+    'message': fields.String(description='The outcome of the item')
+})
+
+purchase_batch_result_model = api.model('PurchaseBatchResult', {
+    'results': fields.List(fields.Nested(purchase_item_result_model),
+                           description='The outcome of every item, in the order of the request body')
+})
+
+purchase_status_model = api.model('PurchaseStatus', {
+    'id': fields.Integer(readOnly=True,
+                         description='The unique id of the queued purchase'),
+    'product_id': fields.Integer(description='The id of the purchased Product'),
+    'user_id': fields.Integer(description='The user id of the person purchasing the Product'),
+    'amount': fields.Integer(description='The amount of the Product'),
+    'status': fields.String(description='pending, done or failed'),
+    'code': fields.Integer(description='The status the purchase would have been answered with once settled'),
+    'message': fields.String(description='The outcome of the latest attempt'),
+    'attempts': fields.Integer(description='The number of times the purchase was sent to the shopcart service'),
+    'created_at': fields.String(description='When the purchase was made'),
+    'updated_at': fields.String(description='When the purchase was last updated')
+})
+
+category_model = api.model('Category', {
+    'category': fields.String(description='The category, in lower case'),
+    'count': fields.Integer(description='The number of Products in the category'),
+    'min_price': fields.Float(description='The lowest price in the category'),
+    'max_price': fields.Float(description='The highest price in the category'),
+    'avg_price': fields.Float(description='The average price in the category')
+})
+
+category_facet_model = api.model('CategoryFacet', {
+    'category': fields.String(description='The category, in lower case'),
+    'count': fields.Integer(description='The number of matching Products in the category')
+})
+
+price_facet_model = api.model('PriceFacet', {
+    'minimum': fields.Float(description='The lowest price of the bucket'),
+    'maximum': fields.Float(description='The price the bucket goes up to, excluded'),
+    'count': fields.Integer(description='The number of matching Products in the bucket')
+})
+
+facets_model = api.model('Facets', {
+    'total': fields.Integer(description='The number of matching Products'),
+    'categories': fields.List(fields.Nested(category_facet_model),
+                              description='The matching Products by category, most first'),
+    'prices': fields.List(fields.Nested(price_facet_model),
+                          description='The matching Products by price bucket, cheapest first, without empty buckets')
+})
+
 # query string arguments
 product_args = reqparse.RequestParser()
 product_args.add_argument('name', type=str, required=False, help='List Products by name')
@@ -78,6 +199,26 @@ product_args.add_argument('category', type=str, required=False, help='List Produ
 product_args.add_argument('description', type=str, required=False, help='List Products by description')
 product_args.add_argument('minimum', type=float, required=False, help='The minimum of the query price range')
 product_args.add_argument('maximum', type=float, required=False, help='The maximum of the query price range')
+product_args.add_argument('limit', type=int, required=False, help='The maximum number of Products in a page')
+product_args.add_argument('cursor', type=str, required=False, help='The opaque cursor of the page to return')
+product_args.add_argument('fields', type=str, required=False, help='The comma separated Product fields to return, e.g. id,name,price')
+product_args.add_argument('sort', type=str, required=False,
+                          help='The comma separated Product fields to order by, descending if prefixed with -, e.g. price,-name')
+
+# the filters of the list without its paging and sort
+export_args = product_args.copy()
+export_args.remove_argument('limit')
+export_args.remove_argument('cursor')
+export_args.remove_argument('sort')
+
+# the filters of the list without its paging and fields
+facet_args = export_args.copy()
+facet_args.remove_argument('fields')
+facet_args.add_argument('width', type=float, required=False, help='The width of the price buckets')
+
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, required=True, help='The words to search for in the name and description of Products')
+search_args.add_argument('limit', type=int, required=False, help='The maximum number of Products to return')
 
 
 ######################################################################
@@ -152,6 +293,17 @@ def internal_server_error(error):
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
 
+######################################################################
+# READ YOUR WRITES
+######################################################################
+@app.after_request
+def pin_writer_to_primary(response):
+    """ Makes a client that wrote read from the primary until the replicas have caught up """
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400 \
+            and replica_binds(app.config):
+        pin(response, app.config['READ_YOUR_WRITES_WINDOW'])
+    return response
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -160,6 +312,28 @@ def index():
     """ Root URL response """
     return render_template('index.html')
 
+######################################################################
+# GET STATS
+######################################################################
+@app.route("/stats")
+def stats():
+    """ Returns the live statistics of the connection pool and the caches """
+    live = dict(
+        pool=pool_status(db.engine),
+        replica_pools={bind: pool_status(db.get_engine(app, bind=bind)) for bind in replica_binds(app.config)},
+        product_cache=Product.cache.stats(),
+        result_cache=result_cache.stats()
+    )
+    # the shopcart client is only loaded by the first purchase
+    shopcart = sys.modules.get("service.shopcart")
+    if shopcart is not None:
+        live.update(
+            shopcart_id_cache=shopcart.cart_ids.stats(),
+            shopcart=shopcart.latency.stats(),
+            shopcart_breaker=shopcart.breaker.stats()
+        )
+    return jsonify(live)
+
 @api.route('/products/<product_id>', strict_slashes=False)
 @api.param('product_id', 'The Product identifier')
 class ProductResource(Resource):
@@ -175,9 +349,11 @@ class ProductResource(Resource):
     # RETRIEVE A PRODUCT
     #------------------------------------------------------------------
     @api.doc('get_products')
+    @api.response(200, 'Success', product_model)
+    @api.response(304, 'Product not modified since the ETag in If-None-Match')
     @api.response(404, 'Product not found')
     @api.response(400, 'Invalid Product ID')
-    @api.marshal_with(product_model)
+    @replica_read
     def get(self, product_id):
         """
         Retrieve a product
@@ -195,8 +371,14 @@ class ProductResource(Resource):
             app.logger.info("Product with id [%s] was not found.", product_id)
             api.abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
 
+        # the ETag is always the one of the body served, even when the cache of this worker is behind
+        etag = product_etag(product.id, product.version)
+        if request.if_none_match and request.if_none_match.contains(etag):
+            app.logger.info("Product with id [%s] not modified.", product_id)
+            return not_modified(etag)
+
         app.logger.info("Returning product with id [%s].", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return marshal(product.serialize(), product_model), status.HTTP_200_OK, etag_header(etag)
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -219,7 +401,7 @@ class ProductResource(Resource):
             app.logger.info("Invalid Product ID.")
             api.abort(status.HTTP_400_BAD_REQUEST, "Invalid Product ID.")
 
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             app.logger.info("Product with id [%s] was not found.", product_id)
             api.abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
@@ -241,13 +423,14 @@ class ProductResource(Resource):
             api.abort(status.HTTP_400_BAD_REQUEST, str(error))
         product.update()
         app.logger.info("Product with id [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product.serialize(), status.HTTP_200_OK, etag_header(product_etag(product.id, product.version))
 
     #------------------------------------------------------------------
     # DELETE A PRODUCT
     #------------------------------------------------------------------
     @api.doc('delete_products')
     @api.response(204, 'Product deleted')
+    @api.response(404, 'Product deleted by another request at the same time')
     def delete(self, product_id):
         """
         Delete a Product
@@ -260,9 +443,10 @@ class ProductResource(Resource):
             app.logger.info("Invalid Product ID.")
             api.abort(status.HTTP_400_BAD_REQUEST, "Invalid Product ID.")
 
-        product = Product.find(product_id)
-        if product:
-            product.delete()
+        product = Product.find(product_id, cached=False)
+        if product and not product.delete():
+            app.logger.info("Product with id [%s] was deleted by another request.", product_id)
+            api.abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
         app.logger.info("Product with id [%s] delete complete.", product_id)
         return make_response(jsonify(message = ''), status.HTTP_204_NO_CONTENT)
 
@@ -286,7 +470,7 @@ class ProductCollection(Resource):
         check_content_type("application/json")
         product = Product()
         product.deserialize(api.payload)
-        if product.id == "" or product.name == "" or product.description == "" or product.price == "" or product.category == "":
+        if has_empty_fields(product):
             app.logger.info("Fields cannot be empty.")
             return api.abort(status.HTTP_400_BAD_REQUEST, "Fields cannot be empty.")
         product.create()
@@ -299,61 +483,237 @@ class ProductCollection(Resource):
     ######################################################################
     @api.doc('list_products')
     @api.expect(product_args, validate=True)
-    @api.response(400, 'Minimum and Maximum cannot be empty')
-    @api.marshal_list_with(product_model)
+    @api.response(200, 'Success', [product_model])
+    @api.response(304, 'Products not modified since the ETag in If-None-Match')
+    @api.response(400, 'Minimum and Maximum cannot be empty, or Invalid limit, or Invalid cursor, or Invalid fields, or Invalid sort')
     @app.route("/products", methods=["GET"])
+    @replica_read
     def get(self):
         """ Returns all of the queried Products """
         app.logger.info("Request for product list")
-        products = []
         args = product_args.parse_args()
-        category = args.get('category')
-        name = args.get('name')
-        description = args.get('description')
-        minimum = args.get('minimum')
-        maximum = args.get('maximum')
-
-        if minimum and maximum:
-            if name and category and description:
-                products = Product.find_by_name_category_description_price(name, category, description, minimum, maximum)
-            elif name and category:
-                products = Product.find_by_name_category_price(name, category, minimum, maximum)
-            elif name and description:
-                products = Product.find_by_name_description_price(name, description, minimum, maximum)
-            elif name:
-                products = Product.find_by_name_price(name, minimum, maximum)
-            elif category and description:
-                products = Product.find_by_category_description_price(category, description, minimum, maximum)
-            elif category:
-                products = Product.find_by_category_price(category, minimum, maximum)
-            elif description:
-                products = Product.find_by_description_price(description, minimum, maximum)
-            else:
-                products = Product.query_by_price(minimum, maximum)
-        elif minimum is None and maximum is None:
-            if name and category and description:
-                products = Product.find_by_name_category_description(name, category, description)
-            elif name and category:
-                products = Product.find_by_name_category(name, category)
-            elif name and description:
-                products = Product.find_by_name_description(name, description)
-            elif name:
-                products = Product.find_by_name(name)
-            elif category and description:
-                products = Product.find_by_category_description(category, description)
-            elif category:
-                products = Product.find_by_category(category)
-            elif description:
-                products = Product.find_by_description(description)
-            else:
-                products = Product.all()
+        filters = query_filters(args)
+        limit = args.get('limit')
+        cursor = args.get('cursor')
+        if limit is None and cursor is not None:
+            limit = DEFAULT_PAGE_LIMIT
+        if limit is not None and (limit < 1 or limit > MAX_PAGE_LIMIT):
+            app.logger.info("Invalid limit.")
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Limit must be between 1 and {}.".format(MAX_PAGE_LIMIT))
+        fields = parse_fields(args.get('fields'))
+        sort = parse_sort(args.get('sort'))
+        after_id, after = decode_cursor(cursor, sort) if cursor else (None, None)
+
+        # both the ETag and the cached response change with every write to the catalog
+        query = tuple(sorted(filters.items())) + (("after_id", after_id), ("after", after), ("limit", limit),
+                                                  ("fields", fields), ("sort", sort))
+        generation = ChangeGeneration.current()
+        etag = collection_etag(generation, query)
+        if request.if_none_match.contains(etag):
+            app.logger.info("Product list not modified.")
+            return not_modified(etag)
+        cached = result_cache.get((generation, query))
+        if cached is None:
+            cached = list_products(filters, after_id, limit, fields, sort, after)
+            result_cache.set((generation, query), cached)
+        body, next_cursor = cached
+        response = Response(body, status=status.HTTP_200_OK, mimetype="application/json")
+        response.set_etag(etag)
+        if next_cursor:
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_page_url(next_cursor))
+        return response
+
+@api.route('/products/export.<any(csv, ndjson):fmt>', strict_slashes=False)
+@api.param('fmt', 'csv or ndjson')
+class ProductExport(Resource):
+    """ Streams the whole catalog or a query of it """
+    ######################################################################
+    # EXPORT PRODUCTS
+    ######################################################################
+    @api.doc('export_products')
+    @api.expect(export_args, validate=True)
+    @api.response(200, 'The Products as CSV with a header line, or as one JSON object per line')
+    @api.response(400, 'Minimum and Maximum cannot be empty, or Invalid fields')
+    @replica_read
+    def get(self, fmt):
+        """
+        Export Products
+        This endpoint will stream every Product matching the same queries as the list of Products, ordered by id,
+        without holding them in memory
+        """
+        app.logger.info("Request to export products as %s", fmt)
+        args = export_args.parse_args()
+        filters = query_filters(args)
+        fields = parse_fields(args.get('fields'))
+        rows = Product.export(app.config['EXPORT_CHUNK_SIZE'], fields=fields, **filters)
+        if fmt == "csv":
+            body, mimetype = stream_csv(rows, fields), "text/csv"
         else:
-            app.logger.info("Minimum and Maximum cannot be empty.")
-            return api.abort(status.HTTP_400_BAD_REQUEST, "Minimum and Maximum cannot be empty.")
+            body, mimetype = stream_ndjson(rows, fields), "application/x-ndjson"
+        return Response(stream_with_context(body), status=status.HTTP_200_OK, mimetype=mimetype,
+                        headers={"Content-Disposition": "attachment; filename=products.{}".format(fmt)})
+
+@api.route('/products/facets', strict_slashes=False)
+class ProductFacets(Resource):
+    """ Counts of the queried Products for filter sidebars """
+    ######################################################################
+    # COUNT PRODUCTS BY CATEGORY AND PRICE
+    ######################################################################
+    @api.doc('facet_products')
+    @api.expect(facet_args, validate=True)
+    @api.response(200, 'Success', facets_model)
+    @api.response(304, 'Facets not modified since the ETag in If-None-Match')
+    @api.response(400, 'Minimum and Maximum cannot be empty, or Invalid width, or Width too small for the price range')
+    @replica_read
+    def get(self):
+        """
+        Count the queried Products by category and price
+        This endpoint will count the Products matching the same queries as the list by category and by price bucket
+        of the given width, in one grouped query
+        """
+        app.logger.info("Request for product facets")
+        args = facet_args.parse_args()
+        filters = query_filters(args)
+        width = args.get('width')
+        if width is None:
+            width = DEFAULT_PRICE_BUCKET_WIDTH
+        check_width(width, filters)
+
+        query = ("facets", width) + tuple(sorted(filters.items()))
+        generation = ChangeGeneration.current()
+        etag = collection_etag(generation, query)
+        if request.if_none_match.contains(etag):
+            app.logger.info("Product facets not modified.")
+            return not_modified(etag)
+        facets = result_cache.get((generation, query))
+        if facets is None:
+            facets = marshal(count_facets(Product.facets(width, **filters), width), facets_model)
+            result_cache.set((generation, query), facets)
+        return facets, status.HTTP_200_OK, etag_header(etag)
+
+@api.route('/products/imports', strict_slashes=False)
+class ProductImportCollection(Resource):
+    """ Handles bulk imports of Products """
+    ######################################################################
+    # IMPORT AN UPLOAD OF PRODUCTS
+    ######################################################################
+    @api.doc('import_products')
+    @api.response(202, 'Import queued, with its status URL in the Location header', import_job_model)
+    @api.response(415, 'Content-Type must be text/csv or application/x-ndjson')
+    def post(self):
+        """
+        Imports Products from a CSV or NDJSON upload
+        This endpoint will store the upload for an import worker to load. A CSV upload has a header line with
+        name, description, category and price, an NDJSON upload has one Product object per line
+        """
+        app.logger.info("Request to import products")
+        fmt = imports.FORMATS.get(request.mimetype)
+        if fmt is None:
+            app.logger.error("Invalid Content-Type: %s", request.headers.get("Content-Type"))
+            abort(415, "Content-Type must be {}".format(" or ".join(imports.FORMATS)))
+        job = imports.submit(fmt, request.stream)
+        app.logger.info("Import with id [%s] queued.", job.id)
+        location_url = api.url_for(ProductImportResource, job_id=job.id, _external=True)
+        return job.serialize(), status.HTTP_202_ACCEPTED, {'Location': location_url}
 
-        results = [product.serialize() for product in products]
-        app.logger.info("Returning %d products.", len(results))
-        return results, status.HTTP_200_OK
+@api.route('/products/imports/<int:job_id>', strict_slashes=False)
+@api.param('job_id', 'The import identifier')
+class ProductImportResource(Resource):
+    """ Progress of the bulk imports of Products """
+    ######################################################################
+    # RETRIEVE THE PROGRESS OF AN IMPORT
+    ######################################################################
+    @api.doc('get_imports')
+    @api.response(404, 'Import not found')
+    @api.marshal_with(import_job_model)
+    def get(self, job_id):
+        """
+        Retrieve the progress of an import
+        This endpoint will return the progress of an import and the lines it rejected
+        """
+        app.logger.info("Request to retrieve import with id: %s", job_id)
+        job = ImportJob.find(job_id)
+        if not job:
+            api.abort(status.HTTP_404_NOT_FOUND, "Import with id '{}' was not found.".format(job_id))
+        return job.serialize(), status.HTTP_200_OK
+
+@api.route('/products/search', strict_slashes=False)
+class ProductSearch(Resource):
+    """ Full text search over Products """
+    ######################################################################
+    # SEARCH PRODUCTS
+    ######################################################################
+    @api.doc('search_products')
+    @api.expect(search_args, validate=True)
+    @api.response(200, 'Success', [product_model])
+    @api.response(400, 'Search terms cannot be empty, or Invalid limit')
+    @replica_read
+    def get(self):
+        """
+        Search Products
+        This endpoint will return the Products whose name or description best match the search terms, most relevant first
+        """
+        args = search_args.parse_args()
+        terms = args.get('q').strip()
+        limit = args.get('limit')
+        app.logger.info("Request to search products for: %s", terms)
+        if not terms:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Search terms cannot be empty.")
+        if limit is None:
+            limit = DEFAULT_SEARCH_LIMIT
+        if limit < 1 or limit > MAX_PAGE_LIMIT:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Limit must be between 1 and {}.".format(MAX_PAGE_LIMIT))
+        products = Product.search(terms, limit)
+        app.logger.info("Returning %d products.", len(products))
+        return Response(render_products(products), status=status.HTTP_200_OK, mimetype="application/json")
+
+@api.route('/products:batch', strict_slashes=False)
+class ProductBatch(Resource):
+    """ Handles bulk creation of Products """
+    ######################################################################
+    # ADD A LIST OF NEW PRODUCTS
+    ######################################################################
+    @api.doc('create_products_batch')
+    @api.expect([create_model])
+    @api.response(400, 'The posted data was not valid, or none of the Products could be created')
+    @api.response(201, 'Products created successfully')
+    @api.response(207, 'Some of the Products could not be created')
+    @api.marshal_with(batch_result_model, code=201)
+    def post(self):
+        """
+        Creates a list of Products
+        This endpoint will create every valid Product in the posted list in a single transaction
+        and report the position and reason of each one that was rejected
+        """
+        app.logger.info("Request to create a batch of products")
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, list) or not data:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Body must be a non-empty list of Products.")
+        if len(data) > MAX_BATCH_SIZE:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "A batch cannot contain more than {} Products.".format(MAX_BATCH_SIZE))
+
+        products = []
+        errors = []
+        for index, item in enumerate(data):
+            product = Product()
+            try:
+                product.deserialize(item)
+            except DataValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+                continue
+            if has_empty_fields(product):
+                errors.append({"index": index, "message": "Fields cannot be empty."})
+                continue
+            products.append(product)
+
+        if not products:
+            app.logger.info("No valid products in batch.")
+            return {"created": [], "errors": errors}, status.HTTP_400_BAD_REQUEST
+        Product.create_many(products)
+        app.logger.info("Created %d products, rejected %d.", len(products), len(errors))
+        code = status.HTTP_207_MULTI_STATUS if errors else status.HTTP_201_CREATED
+        return {"created": [product.serialize() for product in products], "errors": errors}, code
 
 @api.route('/products/<product_id>/purchase', strict_slashes=False)
 @api.param('product_id', 'The Product identifier')
@@ -366,11 +726,15 @@ class PurchaseResource(Resource):
     @api.doc('purchase_products')
     @api.response(200, 'Product successfully added into the shopping cart')
     @api.response(404, 'Product not found, or Product not successfully added into the shopping cart, or Cannot create shopcart so cannot add product into shopping cart, or Product was not added in the shopping cart because of an error')
+    @api.response(202, 'Purchase queued, with its status URL in the Location header', purchase_status_model)
     @api.response(400, 'Fields cannot be empty, or Invalid Product ID. Must be Integer, or Invalid User ID. Must be Integer, or Invalid Amount. Must be Integer')
+    @api.response(503, 'Shopcart service is unavailable')
+    @api.header('Prefer', 'respond-async to queue the purchase and answer 202 without waiting on the shopcart service')
     def post(self, product_id):
         """
         Purchase a product
         This endpoint will purchase a product based on the request body which should include the amount, user id, and shopcart id
+        With a Prefer: respond-async header the purchase is queued and sent to the shopcart service in the background
         """
         app.logger.info("Request to purchase product with id: %s", product_id)
         check_content_type("application/json")
@@ -382,7 +746,7 @@ class PurchaseResource(Resource):
         except ValueError:
             app.logger.info("Invalid Product ID.")
             api.abort(status.HTTP_400_BAD_REQUEST, "Invalid Product ID. Must be Integer")
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             api.abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
         try:
@@ -395,38 +759,128 @@ class PurchaseResource(Resource):
         except ValueError:
             app.logger.info("Invalid Amount.")
             api.abort(status.HTTP_400_BAD_REQUEST, "Invalid Amount. Must be Integer")
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            queued = Purchase(product_id=product.id, user_id=user_id, amount=amount_update,
+                              name=product.name, price=product.price)
+            queued.create()
+            app.logger.info("Purchase with id [%s] queued!", queued.id)
+            location_url = api.url_for(PurchaseStatusResource, purchase_id=queued.id, _external=True)
+            return queued.serialize(), status.HTTP_202_ACCEPTED, {'Location': location_url, 'Preference-Applied': 'respond-async'}
+        header = {'Content-Type': 'application/json'}
+        shopcart = shopcart_client()
+        try:
+            return purchase(product, user_id, amount_update, header)
+        except shopcart.requests.RequestException as error:
+            app.logger.error("Shopcart service call failed: %s", error)
+            return api.abort(status.HTTP_503_SERVICE_UNAVAILABLE, 'Shopcart service is unavailable')
+
+@api.route('/purchases', strict_slashes=False)
+class PurchaseCollection(Resource):
+    """ Purchases of several Products at once """
+    ######################################################################
+    # PURCHASE A LIST OF PRODUCTS
+    ######################################################################
+    @api.doc('purchase_products_batch')
+    @api.expect(purchase_batch_model)
+    @api.response(200, 'Every Product was added into the shopping cart')
+    @api.response(207, 'Some of the Products could not be added into the shopping cart')
+    @api.response(400, 'The posted data was not valid, or none of the items is a valid Product')
+    @api.response(503, 'Shopcart service is unavailable')
+    @api.marshal_with(purchase_batch_result_model)
+    def post(self):
+        """
+        Purchase a list of Products
+        This endpoint will add every item of the request body to the shopping cart of the user, looking up
+        the Products in one query and the shopping cart once, and report the outcome of each item
+        """
+        app.logger.info("Request to purchase a batch of products")
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, dict) or data.get('user_id') in (None, "") or not isinstance(data.get('items'), list) or not data['items']:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Body must have a user_id and a non-empty list of items.")
+        if len(data['items']) > MAX_PURCHASE_ITEMS:
+            return api.abort(status.HTTP_400_BAD_REQUEST, "A purchase cannot contain more than {} items.".format(MAX_PURCHASE_ITEMS))
+        try:
+            user_id = int(data['user_id'])
+        except (TypeError, ValueError):
+            app.logger.info("Invalid User ID.")
+            return api.abort(status.HTTP_400_BAD_REQUEST, "Invalid User ID. Must be Integer")
+
+        results = []
+        wanted = []
+        for index, item in enumerate(data['items']):
+            product_id = item.get('id') if isinstance(item, dict) else None
+            results.append({"index": index, "id": product_id})
+            try:
+                wanted.append((index, int(product_id), int(item['amount'])))
+            except (TypeError, ValueError, KeyError):
+                results[index].update(code=status.HTTP_400_BAD_REQUEST, message="Invalid item. Product id and amount must be Integers")
+        products = {product.id: product for product in Product.find_many([product_id for _, product_id, _ in wanted])}
+        purchases = []
+        for index, product_id, amount in wanted:
+            product = products.get(product_id)
+            if product is None:
+                results[index].update(code=status.HTTP_404_NOT_FOUND, message="Product with id '{}' was not found.".format(product_id))
+                continue
+            purchases.append((index, {"sku": product.id, "amount": amount, "name": product.name, "price": product.price}))
+        if not purchases:
+            app.logger.info("No valid products in purchase.")
+            return {"results": results}, status.HTTP_400_BAD_REQUEST
+
         header = {'Content-Type': 'application/json'}
-        resp = requests.get('{}?user_id={}'.format(SHOPCART_ENDPOINT, user_id))
-        app.logger.info("Trying to purchase product")
-        r_json = resp.json()
-        if len(r_json) == 0:
-            info_json = {"user_id": user_id}
-            create_shopcart_resp = create_shopcart(SHOPCART_ENDPOINT, header, info_json)
-            if create_shopcart_resp.status_code == 201:
-                message = create_shopcart_resp.json()
-                shopcart_id = message['id']
-                new_item = {}
-                new_item["sku"] = product_id
-                new_item["amount"] = amount_update
-                product = product.serialize()
-                new_item["name"] = product["name"]
-                new_item["price"] = product["price"]
-                add_into_shopcart = add_item_to_shopcart(SHOPCART_ENDPOINT + "/{}/items".format(shopcart_id), header, new_item)
-                if add_into_shopcart.status_code == 201:
-                    return make_response(jsonify(message = 'Product successfully added into the shopping cart'), status.HTTP_200_OK)
-                return api.abort(status.HTTP_400_BAD_REQUEST, 'Product not successfully added into the shopping cart')
-            return api.abort(status.HTTP_400_BAD_REQUEST, 'Cannot create shopcart so cannot add product into shopping cart')
-        shopcart_id = r_json[0]['id']
-        new_item = {}
-        new_item["sku"] = product_id
-        new_item["amount"] = amount_update
-        product = product.serialize()
-        new_item["name"] = product["name"]
-        new_item["price"] = product["price"]
-        add_into_shopcart = add_item_to_shopcart(SHOPCART_ENDPOINT + "/{}/items".format(shopcart_id), header, new_item)
-        if add_into_shopcart.status_code == 201:
-            return make_response(jsonify(message = 'Product successfully added into the shopping cart'), status.HTTP_200_OK)
-        return api.abort(status.HTTP_404_NOT_FOUND, 'Product was not added in the shopping cart because of an error')
+        shopcart = shopcart_client()
+        try:
+            outcomes = shopcart.add_purchases(SHOPCART_ENDPOINT, header, user_id, [item for _, item in purchases],
+                                              workers=app.config['SHOPCART_POOL_SIZE'])
+        except shopcart.requests.RequestException as error:
+            app.logger.error("Shopcart service call failed: %s", error)
+            return api.abort(status.HTTP_503_SERVICE_UNAVAILABLE, 'Shopcart service is unavailable')
+        for (index, _), (code, message) in zip(purchases, outcomes):
+            results[index].update(code=code, message=message)
+        added = sum(1 for result in results if result["code"] == status.HTTP_200_OK)
+        app.logger.info("Added %d of %d products into the shopping cart of user %s.", added, len(results), user_id)
+        code = status.HTTP_200_OK if added == len(results) else status.HTTP_207_MULTI_STATUS
+        return {"results": results}, code
+
+@api.route('/purchases/<int:purchase_id>', strict_slashes=False)
+@api.param('purchase_id', 'The queued purchase identifier')
+class PurchaseStatusResource(Resource):
+    """ Status of the purchases queued in the outbox """
+    ######################################################################
+    # RETRIEVE THE STATUS OF A QUEUED PURCHASE
+    ######################################################################
+    @api.doc('get_purchases')
+    @api.response(404, 'Purchase not found')
+    @api.marshal_with(purchase_status_model)
+    def get(self, purchase_id):
+        """
+        Retrieve the status of a queued purchase
+        This endpoint will return whether a purchase made with Prefer: respond-async is still pending, done or failed
+        """
+        app.logger.info("Request to retrieve purchase with id: %s", purchase_id)
+        queued = Purchase.find(purchase_id)
+        if not queued:
+            api.abort(status.HTTP_404_NOT_FOUND, "Purchase with id '{}' was not found.".format(purchase_id))
+        return queued.serialize(), status.HTTP_200_OK
+
+@api.route('/categories', strict_slashes=False)
+class CategoryCollection(Resource):
+    """ Statistics of the Product categories """
+    ######################################################################
+    # LIST CATEGORIES
+    ######################################################################
+    @api.doc('list_categories')
+    @api.marshal_list_with(category_model)
+    @replica_read
+    def get(self):
+        """
+        List the categories
+        This endpoint will return the number of Products and the lowest, highest and average price of every category
+        """
+        app.logger.info("Request to list categories")
+        categories = [stats.serialize() for stats in CategoryStats.all()]
+        app.logger.info("Returning %d categories.", len(categories))
+        return categories, status.HTTP_200_OK
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -437,6 +891,15 @@ def init_db():
     global app
     Product.init_db(app)
 
+def release_connections():
+    """ Closes every database connection and shopcart socket, so that processes forked afterwards open their own """
+    db.session.remove()
+    for bind in [None] + replica_binds(app.config):
+        db.get_engine(app, bind=bind).dispose()
+    shopcart = sys.modules.get("service.shopcart")
+    if shopcart is not None:
+        shopcart.init_client(app.config)
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -444,10 +907,167 @@ def check_content_type(content_type):
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(415, "Content-Type must be {}".format(content_type))
 
-def create_shopcart(url, header, json_data):
-    '''Used to call the create shopcart function'''
-    return requests.post(url, headers=header, json=json_data)
+def has_empty_fields(product):
+    """ Checks whether any of the fields of a deserialized Product is empty """
+    return product.id == "" or product.name == "" or product.description == "" or product.price == "" or product.category == ""
+
+def product_etag(product_id, version):
+    """ Returns the strong ETag of a version of a Product """
+    return "{}-{}".format(product_id, version)
+
+def collection_etag(generation, query):
+    """ Returns the strong ETag of a normalized Product query at a generation of the catalog """
+    return "g{}-{}".format(generation, hashlib.sha1(repr(query).encode("utf-8")).hexdigest()[:16])
+
+def list_products(filters, after_id, limit, fields=PRODUCT_FIELDS, sort=None, after=None):
+    """ Runs a Product query and returns its encoded JSON body and the cursor of the next page """
+    if limit is None:
+        rows = Product.find_by(fields=fields, sort=sort, **filters).all()
+        next_cursor = None
+    else:
+        # the cursor needs the id and the sort fields even if the client did not ask
+        # for them, they are selected last so rendering the requested fields leaves them out
+        keys = tuple(field.lstrip("-") for field in sort or ()) + ("id",)
+        columns = fields + tuple(field for field in dict.fromkeys(keys) if field not in fields)
+        # Fetch one extra row to find out whether there is a next page
+        rows = Product.find_by(after_id=after_id, limit=limit + 1, fields=columns, sort=sort, after=after,
+                               **filters).all()
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last.id, [getattr(last, field.lstrip("-")) for field in sort or ()])
+        rows = rows[:limit]
+    app.logger.info("Returning %d products.", len(rows))
+    return render_rows(rows, fields), next_cursor
+
+def query_filters(args):
+    """ Returns the normalized filters of a Product query from its arguments """
+    minimum = args.get('minimum')
+    maximum = args.get('maximum')
+    if (minimum is None) != (maximum is None):
+        app.logger.info("Minimum and Maximum cannot be empty.")
+        return api.abort(status.HTTP_400_BAD_REQUEST, "Minimum and Maximum cannot be empty.")
+    # string filters are case insensitive, so queries that only differ in case share results
+    return {"name": (args.get('name') or '').lower() or None,
+            "category": (args.get('category') or '').lower() or None,
+            "description": (args.get('description') or '').lower() or None,
+            "minimum": minimum, "maximum": maximum}
+
+def check_width(width, filters):
+    """ Aborts with 400 unless the price buckets of a width are finite and few enough over the queried prices """
+    if not math.isfinite(width) or width < MIN_PRICE_BUCKET_WIDTH:
+        app.logger.info("Invalid width.")
+        api.abort(status.HTTP_400_BAD_REQUEST, "Width must be a number of at least {}.".format(MIN_PRICE_BUCKET_WIDTH))
+    lowest, highest = CategoryStats.price_range()
+    if lowest is None:
+        return
+    if filters.get("minimum") is not None:
+        lowest, highest = max(lowest, filters["minimum"]), min(highest, filters["maximum"])
+    if highest < lowest:
+        return
+    if highest / width > MAX_PRICE_BUCKET or \
+            math.floor(highest / width) - math.floor(lowest / width) + 1 > MAX_PRICE_BUCKETS:
+        app.logger.info("Width too small.")
+        api.abort(status.HTTP_400_BAD_REQUEST,
+                  "Width is too small for the price range, at most {} buckets are counted.".format(MAX_PRICE_BUCKETS))
+
+def count_facets(rows, width):
+    """ Sums (category, bucket, count) rows into the total and the counts by category and by price bucket """
+    categories = {}
+    buckets = {}
+    for category, bucket, count in rows:
+        categories[category] = categories.get(category, 0) + count
+        buckets[bucket] = buckets.get(bucket, 0) + count
+    return {
+        "total": sum(categories.values()),
+        "categories": [{"category": category, "count": count}
+                       for category, count in sorted(categories.items(), key=lambda item: (-item[1], item[0]))],
+        "prices": [{"minimum": bucket * width, "maximum": (bucket + 1) * width, "count": count}
+                   for bucket, count in sorted(buckets.items())]
+    }
+
+def parse_fields(value):
+    """ Returns the product_model fields named in a comma separated list, in the order of product_model """
+    if not value:
+        return PRODUCT_FIELDS
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    if not names or not names.issubset(PRODUCT_FIELDS):
+        app.logger.info("Invalid fields.")
+        return api.abort(status.HTTP_400_BAD_REQUEST, "Fields must be among {}.".format(", ".join(PRODUCT_FIELDS)))
+    return tuple(field for field in PRODUCT_FIELDS if field in names)
+
+def parse_sort(value):
+    """ Returns the product_model fields named in a comma separated sort, each prefixed with - if descending """
+    if not value:
+        return None
+    sort = tuple(field.strip() for field in value.split(","))
+    names = [field.lstrip("-") for field in sort]
+    if not all(name in PRODUCT_FIELDS for name in names) or len(set(names)) != len(names) or \
+            any(field.startswith("--") for field in sort):
+        app.logger.info("Invalid sort.")
+        return api.abort(status.HTTP_400_BAD_REQUEST,
+                         "Sort must be distinct fields among {}, each optionally prefixed with -.".format(", ".join(PRODUCT_FIELDS)))
+    return sort
+
+def etag_header(etag):
+    """ Returns the headers that carry an ETag """
+    return {'ETag': '"{}"'.format(etag)}
+
+def not_modified(etag):
+    """ Returns an empty 304_NOT_MODIFIED response for an ETag """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def encode_cursor(last_id, after=None):
+    """ Encodes the id and the sort values of the last Product in a page into an opaque cursor """
+    cursor = {"id": last_id}
+    if after:
+        cursor["after"] = after
+    data = json.dumps(cursor).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort=None):
+    """ Decodes a cursor back into the id and the sort values of the last Product in a page """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        last_id = data["id"]
+        after = tuple(data["after"]) if sort else None
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        last_id = after = None
+    if not is_column_value("id", last_id) or \
+            (sort and (len(after or ()) != len(sort) or
+                       not all(is_column_value(field.lstrip("-"), value) for field, value in zip(sort, after)))):
+        app.logger.info("Invalid cursor: %s", cursor)
+        api.abort(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+    return last_id, after
+
+def is_column_value(field, value):
+    """ Returns whether a value decoded from a cursor can be compared with the product column of a field """
+    if isinstance(value, bool):
+        return False
+    python_type = Product.__table__.c[field].type.python_type
+    if python_type is float:
+        return isinstance(value, (int, float)) and math.isfinite(value)
+    return isinstance(value, python_type)
+
+def next_page_url(cursor):
+    """ Builds the URL of the next page keeping the current query arguments """
+    args = request.args.copy()
+    args['cursor'] = cursor
+    return "{}?{}".format(request.base_url, url_encode(args))
+
+def shopcart_client():
+    """ Returns the shopcart client, importing and configuring it on the first purchase of the worker """
+    from service import shopcart  # pylint: disable=import-outside-toplevel
+    shopcart.configure(app.config)
+    return shopcart
 
-def add_item_to_shopcart(url, header, json_data):
-    '''Used to call the add item to shopcart function'''
-    return requests.post(url, headers=header, json=json_data)
+def purchase(product, user_id, amount_update, header):
+    """ Adds an amount of a Product to the shopcart of a user, creating the shopcart if needed """
+    app.logger.info("Trying to purchase product")
+    new_item = {"sku": product.id, "amount": amount_update, "name": product.name, "price": product.price}
+    code, message = shopcart_client().add_purchase(SHOPCART_ENDPOINT, header, user_id, new_item)
+    if code == status.HTTP_200_OK:
+        return make_response(jsonify(message=message), status.HTTP_200_OK)
+    return api.abort(code, message)
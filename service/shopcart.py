@@ -0,0 +1,378 @@
+"""
+Shopcart Client
+
+Calls the shopcart service through one pooled, keep-alive requests
+Session per worker. Every call is bounded by connect and read timeouts,
+failed connections are retried a bounded number of times with jittered
+backoff, and the latency of every call is recorded. A circuit breaker
+fails calls fast while the shopcart service keeps failing.
+
+The service only imports this module, and requests with it, on the first
+purchase, and configures the client from the application configuration
+then. Until it is configured the client uses the defaults below
+"""
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from service.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of purchases as told to the buyer
+ADDED = 'Product successfully added into the shopping cart'
+NOT_ADDED = 'Product was not added in the shopping cart because of an error'
+CANNOT_CREATE = 'Cannot create shopcart so cannot add product into shopping cart'
+UNAVAILABLE = 'Shopcart service is unavailable'
+
+# Only these answers of an idempotent call are worth retrying
+RETRY_STATUSES = (502, 503, 504)
+
+
+class JitterRetry(Retry):
+    """ A Retry whose backoff is randomized so that workers do not retry in lockstep """
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """ An HTTPAdapter that bounds every request it sends with a default timeout """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class LatencyStats:
+    """ Thread safe count, error count and latency of calls by name """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, failed=False):
+        """ Records one call of the given name """
+        with self._lock:
+            calls = self._calls.setdefault(name, {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+            calls["count"] += 1
+            calls["errors"] += int(failed)
+            calls["total_time"] += seconds
+            calls["max_time"] = max(calls["max_time"], seconds)
+
+    def clear(self):
+        """ Forgets every recorded call """
+        with self._lock:
+            self._calls.clear()
+
+    def stats(self):
+        """ Returns the count, errors, average and max latency of every call name """
+        with self._lock:
+            return {
+                name: {
+                    "count": calls["count"],
+                    "errors": calls["errors"],
+                    "avg_time": round(calls["total_time"] / calls["count"], 6),
+                    "max_time": round(calls["max_time"], 6)
+                }
+                for name, calls in self._calls.items()
+            }
+
+
+class CircuitOpenError(requests.RequestException):
+    """ Raised instead of calling the shopcart service while the circuit is open """
+
+
+class CircuitBreaker:
+    """
+    A thread safe circuit breaker over the outcomes of the latest calls
+
+    The circuit opens once the failure rate of the latest calls reaches a
+    threshold, and rejects every call until the reset timeout has passed.
+    It then lets a single trial call through: the circuit closes again if
+    it succeeds and opens for another reset timeout if it fails
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_rate: float = 0.5, window: int = 20, min_calls: int = 10,
+                 reset_timeout: float = 30.0, clock=time.monotonic):
+        """
+        Args:
+            failure_rate (float): the share of failed calls that opens the circuit
+            window (int): the number of latest calls the failure rate is computed over
+            min_calls (int): the number of calls needed before the circuit can open
+            reset_timeout (float): the number of seconds the circuit stays open
+            clock (callable): returns the current time in seconds
+        """
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Returns whether a call may be sent now """
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    self.rejected += 1
+                    return False
+                self._trial = True
+            return True
+
+    def record(self, failed):
+        """ Records the outcome of a call that was allowed """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) >= self.failure_rate * len(self._outcomes):
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+
+    def stats(self):
+        """ Returns the state of the circuit and how often it opened and rejected calls """
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "failures": sum(self._outcomes),
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
+
+
+def build_session(connect_timeout=1.0, read_timeout=3.0, retries=2, backoff=0.1, pool_size=10):
+    """ Returns a pooled requests Session with timeouts and bounded retries """
+    retry = JitterRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=backoff,
+        raise_on_status=False
+    )
+    adapter = TimeoutHTTPAdapter((connect_timeout, read_timeout), max_retries=retry,
+                                 pool_connections=1, pool_maxsize=pool_size)
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+session = build_session()
+latency = LatencyStats()
+# user id -> shopcart id, filled by lookups and creations so repeat purchases skip the lookup
+cart_ids = LRUCache()
+breaker = CircuitBreaker()
+configured = False
+_configure_lock = threading.Lock()
+
+
+def init_client(config):
+    """ Rebuilds the shared Session, shopcart id cache and circuit breaker from the application configuration """
+    global session, cart_ids, breaker, configured  # pylint: disable=global-statement
+    cart_ids = LRUCache(config["SHOPCART_ID_CACHE_SIZE"], config["SHOPCART_ID_CACHE_TTL"])
+    breaker = CircuitBreaker(
+        failure_rate=config["SHOPCART_BREAKER_FAILURE_RATE"],
+        window=config["SHOPCART_BREAKER_WINDOW"],
+        min_calls=config["SHOPCART_BREAKER_MIN_CALLS"],
+        reset_timeout=config["SHOPCART_BREAKER_RESET_TIMEOUT"]
+    )
+    session = build_session(
+        connect_timeout=config["SHOPCART_CONNECT_TIMEOUT"],
+        read_timeout=config["SHOPCART_READ_TIMEOUT"],
+        retries=config["SHOPCART_RETRIES"],
+        backoff=config["SHOPCART_BACKOFF"],
+        pool_size=config["SHOPCART_POOL_SIZE"]
+    )
+    configured = True
+
+
+def configure(config):
+    """ Configures the client from the application configuration, unless it already is """
+    if configured:
+        return
+    with _configure_lock:
+        if not configured:
+            init_client(config)
+
+
+def call(name, method, url, **kwargs):
+    """ Sends one request through the shared Session and records its latency """
+    if not breaker.allow():
+        raise CircuitOpenError("The circuit to the shopcart service is open")
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        latency.record(name, time.perf_counter() - start, failed=True)
+        breaker.record(True)
+        raise
+    failed = response.status_code >= 500
+    latency.record(name, time.perf_counter() - start, failed=failed)
+    breaker.record(failed)
+    return response
+
+
+def get_shopcarts(url, user_id):
+    '''Used to call the list shopcarts of a user function'''
+    return call("get_shopcarts", "GET", url, params={"user_id": user_id})
+
+
+def create_shopcart(url, header, json_data):
+    '''Used to call the create shopcart function'''
+    return call("create_shopcart", "POST", url, headers=header, json=json_data)
+
+
+def add_item_to_shopcart(url, header, json_data):
+    '''Used to call the add item to shopcart function'''
+    return call("add_item_to_shopcart", "POST", url, headers=header, json=json_data)
+
+
+def lookup_shopcart(url, header, user_id):
+    """
+    Looks up the shopcart of a user, creating it if the user has none
+
+    Returns the id of the shopcart, or None if it could not be created, and
+    whether it was created
+    """
+    resp = get_shopcarts(url, user_id)
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    if resp.status_code != 200:
+        # the lookup was rejected, which retrying will not change
+        return None, False
+    carts = resp.json()
+    if carts:
+        shopcart_id = carts[0]['id']
+        created = False
+    else:
+        resp = create_shopcart(url, header, {"user_id": user_id})
+        if resp.status_code != 201:
+            return None, True
+        shopcart_id = resp.json()['id']
+        created = True
+    cart_ids.set(user_id, shopcart_id)
+    return shopcart_id, created
+
+
+def add_purchase(url, header, user_id, item):
+    """
+    Adds an item to the shopcart of a user, creating the shopcart if needed
+
+    Returns the HTTP status and the message that describe the outcome to the
+    buyer, and raises requests.RequestException if the service cannot be reached
+    """
+    shopcart_id = cart_ids.get(user_id)
+    if shopcart_id is not None:
+        # a known shopcart saves the lookup, unless it has been deleted since
+        resp = add_item_to_shopcart(url + "/{}/items".format(shopcart_id), header, item)
+        if resp.status_code == 201:
+            return 200, ADDED
+        if resp.status_code != 404:
+            return 404, NOT_ADDED
+        logger.info("Shopcart [%s] of user [%s] no longer exists.", shopcart_id, user_id)
+        cart_ids.invalidate(user_id)
+
+    shopcart_id, created = lookup_shopcart(url, header, user_id)
+    if shopcart_id is None:
+        return 400, CANNOT_CREATE
+    resp = add_item_to_shopcart(url + "/{}/items".format(shopcart_id), header, item)
+    if resp.status_code == 201:
+        return 200, ADDED
+    if created:
+        return 400, 'Product not successfully added into the shopping cart'
+    return 404, NOT_ADDED
+
+
+def add_items(url, header, shopcart_id, items, workers=8):
+    """ Adds items to a shopcart concurrently, returns the status of each in order or None if it failed to send """
+    items_url = url + "/{}/items".format(shopcart_id)
+
+    def add(item):
+        try:
+            return add_item_to_shopcart(items_url, header, item).status_code
+        except requests.RequestException as error:
+            logger.warning("Adding an item to shopcart [%s] failed: %s", shopcart_id, error)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as executor:
+        return list(executor.map(add, items))
+
+
+def add_purchases(url, header, user_id, items, workers=8):
+    """
+    Adds items to the shopcart of a user, creating the shopcart if needed
+
+    The shopcart is resolved once and the items are sent concurrently. Returns
+    the HTTP status and message of every item in order, and raises
+    requests.RequestException if the shopcart cannot be looked up or created
+    """
+    shopcart_id = cart_ids.get(user_id)
+    cached = shopcart_id is not None
+    if not cached:
+        shopcart_id, _ = lookup_shopcart(url, header, user_id)
+        if shopcart_id is None:
+            return [(400, CANNOT_CREATE)] * len(items)
+    codes = add_items(url, header, shopcart_id, items, workers)
+    results = [item_outcome(code) for code in codes]
+    if cached and 404 in codes:
+        # the cached shopcart may have been deleted since, send those items again
+        logger.info("Shopcart [%s] of user [%s] no longer exists.", shopcart_id, user_id)
+        cart_ids.invalidate(user_id)
+        retry = [index for index, code in enumerate(codes) if code == 404]
+        shopcart_id, _ = lookup_shopcart(url, header, user_id)
+        if shopcart_id is None:
+            for index in retry:
+                results[index] = (400, CANNOT_CREATE)
+        else:
+            for index, code in zip(retry, add_items(url, header, shopcart_id, [items[i] for i in retry], workers)):
+                results[index] = item_outcome(code)
+    return results
+
+
+def item_outcome(code):
+    """ Returns the HTTP status and message of an item from the status the shopcart service answered """
+    if code == 201:
+        return 200, ADDED
+    if code is None:
+        return 503, UNAVAILABLE
+    return 404, NOT_ADDED
@@ -0,0 +1,97 @@
+"""
+Stand-in Shopcart Service
+
+A small in-process HTTP server that answers the shopcart calls made by
+purchases, used by the tests and benchmarks instead of the real service
+"""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class ShopcartHandler(BaseHTTPRequestHandler):
+    """ Answers the shopcart API calls from the state of the server """
+    protocol_version = "HTTP/1.1"
+    # send each response in one write so keep-alive connections do not stall on Nagle
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start(self):
+        """ Applies the delay and injected failures, returns False if the call failed """
+        server = self.server
+        server.requests += 1
+        server.connections.add(self.client_address)
+        if server.delay:
+            time.sleep(server.delay)
+        if server.failures:
+            server.failures -= 1
+            self._reply(503, {"message": "unavailable"})
+            return False
+        return True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Lists the shopcarts of a user """
+        if not self._start():
+            return
+        user_id = int(parse_qs(urlparse(self.path).query)["user_id"][0])
+        self._reply(200, [cart for cart in self.server.carts.values() if cart["user_id"] == user_id])
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Creates a shopcart or adds an item to one """
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self._start():
+            return
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) == 1:
+            self.server.last_id += 1
+            cart = {"id": self.server.last_id, "user_id": data["user_id"], "items": []}
+            self.server.carts[cart["id"]] = cart
+            self._reply(201, cart)
+            return
+        cart = self.server.carts.get(int(parts[1]))
+        if cart is None:
+            self._reply(404, {"message": "Shopcart not found"})
+            return
+        cart["items"].append(data)
+        self._reply(201, data)
+
+
+class ShopcartServer(ThreadingHTTPServer):
+    """ A stand-in shopcart service listening on a free local port """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(("127.0.0.1", 0), ShopcartHandler)
+        self.delay = delay
+        self.failures = 0
+        self.requests = 0
+        self.connections = set()
+        self.carts = {}
+        self.last_id = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        """ The URL of the shopcarts collection """
+        return "http://127.0.0.1:{}/shopcarts".format(self.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
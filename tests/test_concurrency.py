@@ -0,0 +1,106 @@
+"""
+Concurrency stress tests
+
+Runs the create, read, update and delete requests of many clients at once,
+each from its own thread, the way the threads of a gthread worker do
+"""
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from flask import has_app_context
+from flask_api import status  # HTTP Status Codes
+from service.models import db, Product, CategoryStats
+from service.service import app, init_db, result_cache
+
+THREADS = 8
+ROUNDS = 10
+
+
+######################################################################
+#  C O N C U R R E N C Y   T E S T   C A S E S
+######################################################################
+class TestConcurrency(TestCase):
+    """ Concurrent requests against one application """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        init_db()
+        app.debug = False
+        app.testing = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
+
+    def setUp(self):
+        """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        Product.cache.clear()
+        result_cache.clear()
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    @staticmethod
+    def _client_session(number):
+        """ Creates, reads, updates and deletes Products as one client, returns the ids it kept and any failure """
+        client = app.test_client()
+        kept = []
+        for round_number in range(ROUNDS):
+            name = "Product {}-{}".format(number, round_number)
+            resp = client.post("/api/products", json={"name": name, "category": "Category {}".format(number % 3),
+                                                      "description": name, "price": 10.0})
+            if resp.status_code != status.HTTP_201_CREATED:
+                return kept, "create answered {}".format(resp.status_code)
+            product = resp.get_json()
+            url = "/api/products/{}".format(product["id"])
+            product["price"] = 20.0
+            resp = client.put(url, json=product, content_type="application/json")
+            if resp.status_code != status.HTTP_200_OK:
+                return kept, "update answered {}".format(resp.status_code)
+            resp = client.get(url)
+            if resp.status_code != status.HTTP_200_OK or resp.get_json() != product:
+                return kept, "read {} of {}".format(resp.status_code, name)
+            if round_number % 2:
+                resp = client.delete(url)
+                if resp.status_code != status.HTTP_204_NO_CONTENT:
+                    return kept, "delete answered {}".format(resp.status_code)
+                resp = client.get(url)
+                # SQLite hands the highest id out again once it is deleted
+                if resp.status_code != status.HTTP_404_NOT_FOUND and resp.get_json()["name"] == name:
+                    return kept, "deleted {} answered {}".format(name, resp.status_code)
+            else:
+                kept.append(product["id"])
+            resp = client.get("/api/products", query_string={"limit": 5})
+            if resp.status_code != status.HTTP_200_OK:
+                return kept, "list answered {}".format(resp.status_code)
+        return kept, None
+
+    def test_concurrent_clients(self):
+        """ Serve many clients writing and reading at once """
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            results = list(executor.map(self._client_session, range(THREADS)))
+        self.assertEqual([failure for _, failure in results], [None] * THREADS)
+        kept = sorted(product_id for ids, _ in results for product_id in ids)
+        resp = app.test_client().get("/api/products")
+        self.assertEqual(sorted(product["id"] for product in resp.get_json()), kept)
+        # the category statistics were kept in step with every write
+        stats = {row.category: (row.count, row.total) for row in CategoryStats.all()}
+        self.assertEqual(sum(count for count, _ in stats.values()), len(kept))
+        self.assertEqual(sum(total for _, total in stats.values()), 20.0 * len(kept))
+
+    def test_request_scoped_sessions(self):
+        """ Give every request its own application context and session """
+        self.context.pop()
+        try:
+            init_db()
+            self.assertFalse(has_app_context())
+            resp = app.test_client().get("/api/products")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # the teardown of the request removed its session
+            self.assertFalse(db.session.registry.has())
+        finally:
+            self.context.push()
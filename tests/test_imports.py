@@ -0,0 +1,117 @@
+"""
+Test cases for the Import Worker
+
+"""
+import io
+import json
+import unittest
+from unittest.mock import patch
+from datetime import datetime, timedelta
+from service.models import Product, ImportJob, ImportUpload, db
+from service import app, imports
+
+UPLOAD = (
+    "name,description,category,price\n"
+    "Cake,Chocolate Cake,Food,10.50\n"
+    "Bad,Bad price,Food,abc\n"
+    "Pie,Apple Pie,Food,4\n"
+    "Bread,White Bread,Food,2\n"
+    "Tea,Green Tea,Drinks,3\n"
+)
+
+
+######################################################################
+# I M P O R T   W O R K E R   T E S T   C A S E S
+######################################################################
+class TestImports(unittest.TestCase):
+    """ Test Cases for the Import Worker """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.debug = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
+        Product.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_claim(self):
+        """ Claim every pending import once, and running ones only when their worker stopped """
+        first = imports.submit("csv", io.BytesIO(UPLOAD.encode("utf-8"))).id
+        second = imports.submit("csv", io.BytesIO(UPLOAD.encode("utf-8"))).id
+        now = datetime.utcnow()
+        self.assertEqual(ImportJob.claim(now - timedelta(seconds=60)).id, first)
+        self.assertEqual(ImportJob.claim(now - timedelta(seconds=60)).id, second)
+        self.assertIsNone(ImportJob.claim(now - timedelta(seconds=60)))
+        job = ImportJob.claim(datetime.utcnow() + timedelta(seconds=1))
+        self.assertEqual((job.id, job.status), (first, ImportJob.RUNNING))
+
+    def test_resume_after_dead_worker(self):
+        """ Take over an import whose worker died and resume it after its last chunk """
+        job_id = imports.submit("csv", io.BytesIO(UPLOAD.encode("utf-8"))).id
+        commit_chunk = imports.commit_chunk
+        commits = []
+
+        def die_after_first_chunk(*args):
+            if commits:
+                raise KeyboardInterrupt
+            commits.append(args)
+            commit_chunk(*args)
+
+        with patch.dict(app.config, {"IMPORT_CHUNK_SIZE": 2}):
+            with patch("service.imports.commit_chunk", side_effect=die_after_first_chunk):
+                self.assertRaises(KeyboardInterrupt, imports.process, app)
+            # the first chunk and its rejected line are committed
+            job = ImportJob.find(job_id)
+            self.assertEqual((job.status, job.lines, job.imported, job.rejected), (ImportJob.RUNNING, 2, 1, 1))
+            self.assertEqual(json.loads(job.errors), [{"line": 3, "message": "Invalid Price Input"}])
+            # the job is not taken over while its worker may still be alive
+            self.assertFalse(imports.process(app))
+            with patch.dict(app.config, {"IMPORT_STALE_AFTER": -1}):
+                self.assertTrue(imports.process(app))
+        job = ImportJob.find(job_id)
+        self.assertEqual((job.status, job.lines, job.imported, job.rejected), (ImportJob.DONE, 5, 4, 1))
+        self.assertEqual(sorted(product.name for product in Product.all()), ["Bread", "Cake", "Pie", "Tea"])
+        self.assertEqual(ImportUpload.query.count(), 0)
+
+    def test_read_across_pieces(self):
+        """ Import an upload whose characters and quoted lines span its pieces """
+        upload = 'name,description,category,price\nCrème,"Crème\nbrûlée",Food,6\nTea,Green Tea,Drinks,3\n'
+        job = ImportJob(format="csv")
+        db.session.add(job)
+        db.session.flush()
+        job_id = job.id
+        ImportUpload.store(job_id, io.BytesIO(upload.encode("utf-8")), chunk_size=5)
+        db.session.commit()
+        self.assertEqual("".join(imports.read_lines(job_id)), upload)
+        self.assertTrue(imports.process(app))
+        job = ImportJob.find(job_id)
+        self.assertEqual((job.status, job.lines, job.imported, job.rejected), (ImportJob.DONE, 2, 2, 0))
+        self.assertEqual(sorted(product.description for product in Product.all()), ["Crème\nbrûlée", "Green Tea"])
+
+    def test_failed_import(self):
+        """ Fail an import that cannot be read and drop its upload """
+        job_id = imports.submit("csv", io.BytesIO(b"name,description,category,price\n\xff\n")).id
+        self.assertTrue(imports.process(app))
+        job = ImportJob.find(job_id)
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn("utf-8", job.message)
+        self.assertEqual(ImportUpload.query.count(), 0)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -7,8 +7,11 @@ import unittest
 #import os
 #import json
 from unittest.mock import patch
+from sqlalchemy import event
 from sqlalchemy.exc import InvalidRequestError
-from service.models import Product, DataValidationError, db
+from sqlalchemy.orm import make_transient_to_detached
+from service.models import Product, CategoryStats, ChangeGeneration, SchemaVersion, DataValidationError, db
+from service.models import SCHEMA_VERSION
 from service import app
 
 ######################################################################
@@ -24,20 +27,41 @@ class TestProductModel(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
         Product.init_db(app)
 
-    @classmethod
-    def tearDownClass(cls):
-        """ This runs once after the entire test suite """
-        db.session.close()
-
     def setUp(self):
         """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
         db.drop_all()
         db.create_all()
+        Product.cache.clear()
 
     def tearDown(self):
         """ This runs after each test """
         db.session.remove()
         db.drop_all()
+        self.context.pop()
+
+    @staticmethod
+    def _query_plan(run):
+        """ Returns the query plan the database picks for the last query issued by run() """
+        statements = []
+
+        def capture(_conn, _cursor, statement, parameters, _context, _executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            run()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        statement, parameters = statements[-1]
+        with db.engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute("SET LOCAL enable_seqscan = off")
+                rows = connection.execute("EXPLAIN " + statement, parameters)
+            else:
+                rows = connection.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return "\n".join(str(row[-1]) for row in rows)
 
 ######################################################################
 #  P L A C E   T E S T   C A S E S   H E R E
@@ -94,6 +118,17 @@ class TestProductModel(unittest.TestCase):
         products = Product.all()
         self.assertEqual(len(products), 1)
 
+    def test_add_many_products(self):
+        """ Create a list of products in a single transaction """
+        products = [Product(name="Cake", description="Chocolate Cake", category="Food", price=price)
+                    for price in (1.5, 2.5, 3.5)]
+        Product.create_many(products)
+        self.assertEqual([product.id for product in products], [1, 2, 3])
+        self.assertEqual(len(Product.all()), 3)
+        self.assertEqual(Product.find(2).price, 2.5)
+        Product.create_many([])
+        self.assertEqual(len(Product.all()), 3)
+
     @patch('service.models.db.session.commit')
     def test_add_a_product_commit_error(self,commit):
         """ Create a product and raises an InvalidRequestError """
@@ -123,6 +158,23 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(products[0].price, 9999.99)
         self.assertEqual(products[0].description, "White iPhone")
 
+    def test_versions_and_generations(self):
+        """ Writes bump the Product version and the catalog generation """
+        self.assertEqual(ChangeGeneration.current(), 0)
+        product = Product(name="iPhone X", description="Black iPhone", category="Technology", price=999.99)
+        product.create()
+        self.assertEqual(product.version, 1)
+        self.assertIsNotNone(product.updated_at)
+        self.assertEqual(ChangeGeneration.current(), 1)
+        product.price = 9999.99
+        product.update()
+        self.assertEqual(product.version, 2)
+        self.assertEqual(ChangeGeneration.current(), 2)
+        Product.create_many([Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50)])
+        self.assertEqual(ChangeGeneration.current(), 3)
+        product.delete()
+        self.assertEqual(ChangeGeneration.current(), 4)
+
     def test_update_a_product_commit_error(self):
         """ Update a product and raises an InvalidRequestError """
         product = Product(name="iPhone X", description="Black iPhone", category="Technology", price=999.99)
@@ -161,6 +213,48 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(product.category, "Technology")
         self.assertEqual(product.price, 1999.99)
 
+    def test_find_product_cached(self):
+        """ Find a Product from the cache """
+        product = Product(name="TV", description="Black Sony TV", category="Technology", price=1999.99)
+        product.create()
+        self.assertEqual(Product.find(product.id).name, "TV")
+        with patch('service.models.Product.query') as query:
+            cached = Product.find(product.id)
+            query.get.assert_not_called()
+        self.assertEqual(cached.id, product.id)
+        self.assertEqual(cached.serialize(), product.serialize())
+        self.assertEqual(Product.cache.stats()["hits"], 1)
+        # a cached Product can still be updated and deleted
+        cached.price = 999.99
+        cached.update()
+        self.assertEqual(Product.find(product.id).price, 999.99)
+        Product.find(product.id).delete()
+        self.assertIsNone(Product.find(product.id))
+        self.assertEqual(Product.all(), [])
+
+    def test_find_product_uncached(self):
+        """ Find a Product in the database past the cache """
+        product = Product(name="TV", description="Black Sony TV", category="Technology", price=1999.99)
+        product.create()
+        product_id = product.id
+        self.assertEqual(Product.find(product_id).price, 1999.99)
+        db.session.execute("UPDATE product SET price = 999.99 WHERE id = :id", {"id": product_id})
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEqual(Product.find(product_id).price, 1999.99)
+        self.assertEqual(Product.find(product_id, cached=False).price, 999.99)
+
+    def test_find_product_not_found_cached(self):
+        """ Find a Product that does not exist is cached as a miss """
+        self.assertIsNone(Product.find(1))
+        with patch('service.models.Product.query') as query:
+            self.assertIsNone(Product.find(1))
+            query.get.assert_not_called()
+        # creating the Product invalidates the cached miss
+        product = Product(name="TV", description="Black Sony TV", category="Technology", price=1999.99)
+        product.create()
+        self.assertEqual(Product.find(1).name, "TV")
+
     def test_find_by_category(self):
         """ Find Products by Category """
         Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
@@ -201,115 +295,205 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(products[0].description, "Black iPhone")
         self.assertEqual(products[0].price, 9999.99)
 
-    def test_find_by_name_category(self):
-        """ Find Products by Name and Category """
+    def test_find_by_criteria(self):
+        """ Find Products by any combination of criteria """
         Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
         Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_category("iPhone x", "technology")
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_description(self):
-        """ Find Products by Name and Description """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_description("iPhone x", "iPhone")
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_price(self):
-        """ Find Products by Name and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
+        Product(name="iPhone Cake", description="Cake shaped like an iPhone", category="Food", price=50.00).create()
+        criteria = [
+            ({"name": "iPhone x", "category": "technology"}, [1]),
+            ({"name": "iphone", "description": "iPhone"}, [1, 3]),
+            ({"name": "iPhone", "minimum": 800, "maximum": 10000}, [1]),
+            ({"category": "food", "description": "cake"}, [2, 3]),
+            ({"category": "FOOD", "minimum": 20, "maximum": 100}, [3]),
+            ({"description": "iPhone", "minimum": 10, "maximum": 100}, [3]),
+            ({"name": "cake", "category": "food", "description": "chocolate"}, [2]),
+            ({"name": "iPhone", "category": "food", "minimum": 10, "maximum": 100}, [3]),
+            ({"name": "iPhone", "description": "black", "minimum": 10, "maximum": 100}, []),
+            ({"category": "technology", "description": "iPhone", "minimum": 800, "maximum": 10000}, [1]),
+            ({"name": "iPhone x", "category": "technology", "description": "iPhone", "minimum": 800, "maximum": 10000}, [1]),
+            ({"minimum": 20}, [1, 3]),
+            ({"maximum": 20}, [2]),
+            ({}, [1, 2, 3]),
+        ]
+        for kwargs, ids in criteria:
+            # run every shape twice so the second run comes from the cache
+            for _ in range(2):
+                products = Product.find_by(**kwargs).all()
+                self.assertEqual(sorted(product.id for product in products), ids, kwargs)
+
+    def test_find_by_page(self):
+        """ Page through Products after a given id """
+        for price in range(5):
+            Product(name="Cake", description="Chocolate Cake", category="Food", price=price).create()
+        page = Product.find_by(limit=2).all()
+        self.assertEqual([product.id for product in page], [1, 2])
+        page = Product.find_by(after_id=page[-1].id, limit=2).all()
+        self.assertEqual([product.id for product in page], [3, 4])
+        page = Product.find_by(minimum=3, maximum=10, after_id=4, limit=2).all()
+        self.assertEqual([product.id for product in page], [5])
+
+    def test_find_by_fields(self):
+        """ Find rows of only some columns of Products """
         Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_price("iPhone x", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_category_description(self):
-        """ Find Products by Category and Description """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
+        Product(name="iPhone", description="Black iPhone", category="Technology", price=999.99).create()
+        for fields in (("id", "name", "price"), ("name",)):
+            rows = Product.find_by(category="food", fields=fields).all()
+            self.assertEqual(len(rows), 1)
+            self.assertNotIsInstance(rows[0], Product)
+            self.assertEqual(len(rows[0]), len(fields))
+            self.assertEqual(rows[0].name, "Cake")
+        rows = Product.find_by(after_id=1, limit=5, fields=("price", "id")).all()
+        self.assertEqual([tuple(row) for row in rows], [(999.99, 2)])
+
+    def test_export(self):
+        """ Stream the Products matching a query in chunks """
+        for price in range(5):
+            Product(name="Cake", description="Chocolate Cake", category="Food", price=price).create()
+        Product(name="iPhone", description="Black iPhone", category="Technology", price=999.99).create()
+        rows = Product.export(2, category="food", fields=("id", "price"))
+        self.assertEqual([tuple(row) for row in rows], [(1, 0), (2, 1), (3, 2), (4, 3), (5, 4)])
+        self.assertEqual([product.id for product in Product.export(2)], [1, 2, 3, 4, 5, 6])
+
+    def test_category_stats(self):
+        """ Category statistics follow creates, updates and deletes """
+        def stats():
+            return {row.category: (row.count, row.total, row.minimum, row.maximum) for row in CategoryStats.all()}
+        cake = Product(name="Cake", description="Chocolate Cake", category="Food", price=10)
+        cake.create()
+        Product.create_many([
+            Product(name="Pie", description="Apple Pie", category="food", price=4),
+            Product(name="Bread", description="Rye Bread", category="FOOD", price=2),
+            Product(name="iPhone", description="Black iPhone", category="Technology", price=999)
+        ])
+        self.assertEqual(stats(), {"food": (3, 16, 2, 10), "technology": (1, 999, 999, 999)})
+        cake.price = 1
+        cake.update()
+        self.assertEqual(stats(), {"food": (3, 7, 1, 4), "technology": (1, 999, 999, 999)})
+        cake.category = "Technology"
+        cake.update()
+        self.assertEqual(stats(), {"food": (2, 6, 2, 4), "technology": (2, 1000, 1, 999)})
+        Product.find_by_name("Bread")[0].delete()
+        self.assertEqual(stats(), {"food": (1, 4, 4, 4), "technology": (2, 1000, 1, 999)})
+        Product.find_by_name("Pie")[0].delete()
+        self.assertEqual(stats(), {"technology": (2, 1000, 1, 999)})
+        self.assertEqual(CategoryStats.all()[0].serialize(),
+                         {"category": "technology", "count": 2, "min_price": 1, "max_price": 999, "avg_price": 500})
+
+    def test_category_stats_backfill(self):
+        """ Category statistics are filled in for the Products that existed before them """
+        Product(name="Cake", description="Chocolate Cake", category="Food", price=10).create()
+        Product(name="Pie", description="Apple Pie", category="Food", price=4).create()
+        CategoryStats.query.delete()
+        db.session.commit()
+        Product.upgrade_schema(db.engine)
+        self.assertEqual([row.serialize() for row in CategoryStats.all()],
+                         [{"category": "food", "count": 2, "min_price": 4, "max_price": 10, "avg_price": 7}])
+
+    def test_schema_version(self):
+        """ Build the schema only when its stamped version is older than the code """
+        self.context.pop()
+        try:
+            with patch("service.models.db.create_all") as create_all:
+                Product.init_db(app)
+                create_all.assert_called_once()
+            self.assertEqual(SchemaVersion.current(db.get_engine(app)), SCHEMA_VERSION)
+            with patch("service.models.db.create_all") as create_all:
+                Product.init_db(app)
+                create_all.assert_not_called()
+            SchemaVersion.stamp(db.get_engine(app), SCHEMA_VERSION - 1)
+            with patch("service.models.db.create_all") as create_all:
+                Product.init_db(app)
+                create_all.assert_called_once()
+            with patch.dict(app.config, {"DATABASE_SCHEMA_CHECK": False}):
+                with patch("service.models.db.create_all") as create_all:
+                    Product.init_db(app)
+                    create_all.assert_called_once()
+        finally:
+            self.context.push()
+
+    def test_facets(self):
+        """ Count Products by category and price bucket """
+        for name, category, price in (("Cake", "Food", 5), ("Pie", "food", 150), ("Bread", "Food", 199.99),
+                                      ("iPhone", "Technology", 999), ("Cable", "Technology", 10)):
+            Product(name=name, description=name, category=category, price=price).create()
+        self.assertEqual(sorted(Product.facets(100)),
+                         [("food", 0, 1), ("food", 1, 2), ("technology", 0, 1), ("technology", 9, 1)])
+        self.assertEqual(sorted(Product.facets(50, category="FOOD", minimum=100, maximum=200)), [("food", 3, 2)])
+        self.assertEqual(sorted(Product.facets(1000, name="c")), [("food", 0, 1), ("technology", 0, 1)])
+
+    def test_category_query_uses_index(self):
+        """ Category queries use the lower(category) index """
         Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_category_description("technology", "iPhone")
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_category_price(self):
-        """ Find Products by Category and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
+        plan = self._query_plan(lambda: Product.find_by_category("food"))
+        self.assertIn("ix_product_category_lower", plan)
+
+    def test_find_by_sort(self):
+        """ Sort Products and continue after one of them """
+        for name, price in (("Cake", 5), ("Pie", 10), ("Bread", 5), ("Tart", 10), ("Bun", 1)):
+            Product(name=name, description=name, category="Food", price=price).create()
+        names = [product.name for product in Product.find_by(sort=("price",))]
+        self.assertEqual(names, ["Bun", "Cake", "Bread", "Pie", "Tart"])
+        names = [product.name for product in Product.find_by(sort=("-price",))]
+        self.assertEqual(names, ["Tart", "Pie", "Bread", "Cake", "Bun"])
+        names = [product.name for product in Product.find_by(sort=("-price", "name"), limit=3)]
+        self.assertEqual(names, ["Pie", "Tart", "Bread"])
+        # after Bread (id 3) at 5 in either sort
+        rows = Product.find_by(sort=("price",), after_id=3, after=(5,), fields=("name",))
+        self.assertEqual([row.name for row in rows], ["Pie", "Tart"])
+        rows = Product.find_by(sort=("-price", "name"), after_id=3, after=(5, "Bread"), fields=("name",))
+        self.assertEqual([row.name for row in rows], ["Cake", "Bun"])
+
+    def test_sort_uses_price_indexes(self):
+        """ Sorts on price walk the price indexes instead of sorting """
         Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_category_price("technology", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_description_price(self):
-        """ Find Products by Description and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_description_price("iPhone", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_category_description(self):
-        """ Find Products by Name, Category and Description """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_category_description("iPhone x", "technology", "iPhone")
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_category_price(self):
-        """ Find Products by Name, Category and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_category_price("iPhone x", "technology", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_description_price(self):
-        """ Find Products by Name, Descrption and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_description_price("iPhone x", "iPhone", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_category_description_price(self):
-        """ Find Products by Category, Description and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
-        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_category_description_price("technology", "iPhone", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
-
-    def test_find_by_name_category_description_price(self):
-        """ Find Products by Name, Category, Description and Price """
-        Product(name="iPhone X", description="Black iPhone", category="Technology", price=9999.99).create()
+        plan = self._query_plan(lambda: Product.find_by(category="food", sort=("price",), limit=20).all())
+        self.assertIn("ix_product_category_lower_price", plan)
+        plan = self._query_plan(lambda: Product.find_by(minimum=1, maximum=20, sort=("-price",), limit=20).all())
+        self.assertIn("ix_product_price", plan)
+        if db.engine.dialect.name == "sqlite":
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_substring_queries_use_trigram_indexes(self):
+        """ Name and description queries use the trigram indexes """
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("trigram indexes are only created on PostgreSQL")
+        Product(name="iPhone X", description="Black iPhone", category="Technology", price=999.99).create()
+        plan = self._query_plan(lambda: Product.find_by_name("phone"))
+        self.assertIn("ix_product_name_trgm", plan)
+        plan = self._query_plan(lambda: Product.find_by_description("black"))
+        self.assertIn("ix_product_description_trgm", plan)
+
+    def test_optional_ddl(self):
+        """ Skip the DDL of a feature the database does not support, without aborting the transaction """
+        with db.engine.begin() as connection:
+            with self.assertLogs("service.models", "WARNING"):
+                self.assertFalse(Product._optional_ddl(connection, ["CREATE INDEX ix_nothing ON nothing (id)"], "No"))
+            self.assertTrue(Product._optional_ddl(connection, ["CREATE INDEX IF NOT EXISTS ix_product_name ON product (name)"], "No"))
+            self.assertEqual(connection.execute("SELECT count(*) FROM product").scalar(), 0)
+        # SQLite searches its own full text table
+        self.assertFalse(Product.has_search_vector())
+
+    def test_search(self):
+        """ Full text search over name and description """
+        Product(name="iPhone X", description="Black iPhone", category="Technology", price=999.99).create()
         Product(name="Cake", description="Chocolate Cake", category="Food", price=10.50).create()
-        products = Product.find_by_name_category_description_price("iPhone x", "technology", "iPhone", 800, 10000)
-        self.assertEqual(products[0].category, "Technology")
-        self.assertEqual(products[0].name, "iPhone X")
-        self.assertEqual(products[0].description, "Black iPhone")
-        self.assertEqual(products[0].price, 9999.99)
+        cake = Product(name="Black Forest", description="Chocolate and cherry cake", category="Food", price=25.00)
+        cake.create()
+        products = Product.search("cake", 10)
+        self.assertEqual(sorted(product.id for product in products), [2, 3])
+        products = Product.search("black", 10)
+        self.assertEqual(sorted(product.id for product in products), [1, 3])
+        products = Product.search("chocolate cherry", 10)
+        self.assertEqual([product.id for product in products], [3])
+        self.assertEqual(len(Product.search("cake", 1)), 1)
+        self.assertEqual(Product.search("-*\"", 10), [])
+        # the index follows updates and deletes
+        cake.description = "Cherry pie"
+        cake.update()
+        self.assertEqual([product.id for product in Product.search("cake", 10)], [2])
+        Product.find(2).delete()
+        self.assertEqual(Product.search("cake", 10), [])
 
     def test_delete_a_product(self):
         """ Delete a Product """
@@ -320,6 +504,20 @@ class TestProductModel(unittest.TestCase):
         product.delete()
         self.assertEqual(len(Product.all()), 0)
 
+    def test_delete_a_product_twice(self):
+        """ Delete a Product that another request deleted first """
+        Product(name="Cake", description="Chocolate Cake", category="Food", price=10.0).create()
+        product = Product(name="Pie", description="Apple Pie", category="Food", price=4.0)
+        product.create()
+        # a copy of the row, like the one another request holds
+        copy = Product(**product.columns())
+        make_transient_to_detached(copy)
+        self.assertTrue(product.delete())
+        self.assertFalse(copy.delete())
+        self.assertEqual([row.serialize() for row in CategoryStats.all()],
+                         [{"category": "food", "count": 1, "min_price": 10, "max_price": 10, "avg_price": 10}])
+        self.assertEqual(ChangeGeneration.current(), 3)
+
     def test_delete_a_product_commit_error(self):
         """ Delete a Product """
         product = Product(name="iPhone X", description="Black iPhone", category="Technology", price=999.99)
@@ -0,0 +1,143 @@
+"""
+Test cases for the Purchase Outbox Dispatcher
+
+"""
+import unittest
+from unittest.mock import patch
+from datetime import datetime, timedelta
+from service.models import Product, Purchase, db
+from service import app, shopcart, outbox
+from tests.shopcart_server import ShopcartServer
+
+
+######################################################################
+# O U T B O X   T E S T   C A S E S
+######################################################################
+class TestOutbox(unittest.TestCase):
+    """ Test Cases for the Purchase Outbox Dispatcher """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.debug = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
+        Product.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        self.session = shopcart.session
+        self.breaker = shopcart.breaker
+        shopcart.session = shopcart.build_session(connect_timeout=0.5, read_timeout=0.5, retries=0, backoff=0)
+        shopcart.breaker = shopcart.CircuitBreaker(min_calls=1000)
+        shopcart.cart_ids.clear()
+
+    def tearDown(self):
+        """ This runs after each test """
+        shopcart.session = self.session
+        shopcart.breaker = self.breaker
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    @staticmethod
+    def _queue(user_id, product_id):
+        purchase = Purchase(product_id=product_id, user_id=user_id, amount=1, name="item", price=1.0)
+        purchase.create()
+        return purchase
+
+    def test_dispatch_in_order(self):
+        """ Send the purchases of every user in the order they were made """
+        purchases = [self._queue(user_id, product_id) for product_id in range(1, 4) for user_id in (7, 8)]
+        with ShopcartServer() as server:
+            self.assertEqual(outbox.dispatch(server.endpoint, workers=2), 6)
+            self.assertEqual(outbox.dispatch(server.endpoint), 0)
+        self.assertEqual(len(server.carts), 2)
+        for cart in server.carts.values():
+            self.assertEqual([item["sku"] for item in cart["items"]], [1, 2, 3])
+        for purchase in purchases:
+            purchase = Purchase.find(purchase.id)
+            self.assertEqual(purchase.status, Purchase.DONE)
+            self.assertEqual(purchase.code, 200)
+            self.assertEqual(purchase.attempts, 1)
+
+    def test_retry_with_backoff(self):
+        """ Retry a purchase that could not reach the service, holding back the later ones of the user """
+        first, second = self._queue(7, 1), self._queue(7, 2)
+        with ShopcartServer() as server:
+            server.failures = 1
+            self.assertEqual(outbox.dispatch(server.endpoint, backoff=60), 0)
+            first = Purchase.find(first.id)
+            self.assertEqual(first.status, Purchase.PENDING)
+            self.assertEqual(first.attempts, 1)
+            self.assertGreater(first.next_attempt_at, datetime.utcnow() + timedelta(seconds=30))
+            self.assertEqual(Purchase.find(second.id).attempts, 0)
+            # nothing of the user is sent before the first purchase is due
+            self.assertEqual(outbox.dispatch(server.endpoint), 0)
+            self.assertEqual(server.requests, 1)
+            first.next_attempt_at = datetime.utcnow()
+            db.session.commit()
+            self.assertEqual(outbox.dispatch(server.endpoint), 2)
+        self.assertEqual([item["sku"] for item in server.carts[1]["items"]], [1, 2])
+
+    def test_fail_after_max_attempts(self):
+        """ Give up on a purchase after the last attempt """
+        purchase = self._queue(7, 1)
+        with ShopcartServer() as server:
+            server.failures = 2
+            self.assertEqual(outbox.dispatch(server.endpoint, max_attempts=2, backoff=0), 0)
+            self.assertEqual(outbox.dispatch(server.endpoint, max_attempts=2, backoff=0), 1)
+        purchase = Purchase.find(purchase.id)
+        self.assertEqual(purchase.status, Purchase.FAILED)
+        self.assertEqual(purchase.code, 503)
+        self.assertEqual(purchase.attempts, 2)
+
+    def test_circuit_open_not_counted(self):
+        """ Reschedule the purchases that fail while the circuit is open without counting an attempt """
+        purchase = self._queue(7, 1)
+        shopcart.breaker = shopcart.CircuitBreaker(min_calls=1, reset_timeout=60)
+        with ShopcartServer() as server:
+            server.failures = 1
+            # the failure opens the circuit, and the circuit then rejects the calls
+            for _ in range(3):
+                self.assertEqual(outbox.dispatch(server.endpoint, max_attempts=1, backoff=0), 0)
+            self.assertEqual(server.requests, 1)
+            purchase = Purchase.find(purchase.id)
+            self.assertEqual(purchase.status, Purchase.PENDING)
+            self.assertEqual(purchase.attempts, 0)
+            shopcart.breaker = shopcart.CircuitBreaker(min_calls=1000)
+            self.assertEqual(outbox.dispatch(server.endpoint, max_attempts=1, backoff=0), 1)
+        self.assertEqual(Purchase.find(purchase.id).status, Purchase.DONE)
+
+    def test_dispatch_due_users(self):
+        """ Send the purchases of users that are due past the older ones that are backing off """
+        waiting = self._queue(7, 1)
+        waiting.next_attempt_at = datetime.utcnow() + timedelta(seconds=60)
+        db.session.commit()
+        due = self._queue(8, 2)
+        with ShopcartServer() as server:
+            self.assertEqual(outbox.dispatch(server.endpoint, batch_size=1), 1)
+        self.assertEqual(Purchase.find(due.id).status, Purchase.DONE)
+        self.assertEqual(Purchase.find(waiting.id).status, Purchase.PENDING)
+
+    def test_unexpected_answer(self):
+        """ Fail a purchase with an unexpected answer without losing the outcomes of the others """
+        failing, sent = self._queue(7, 1), self._queue(8, 2)
+        add_purchase = shopcart.add_purchase
+
+        def answer(url, header, user_id, item):
+            if user_id == 7:
+                raise KeyError("id")
+            return add_purchase(url, header, user_id, item)
+
+        with ShopcartServer() as server, patch("service.shopcart.add_purchase", side_effect=answer):
+            self.assertEqual(outbox.dispatch(server.endpoint, workers=2, backoff=60), 1)
+            self.assertEqual(outbox.dispatch(server.endpoint), 0)
+        self.assertEqual(len(server.carts), 1)
+        self.assertEqual(Purchase.find(sent.id).status, Purchase.DONE)
+        failing = Purchase.find(failing.id)
+        self.assertEqual(failing.status, Purchase.PENDING)
+        self.assertEqual(failing.attempts, 1)
@@ -0,0 +1,49 @@
+"""
+Test cases for the JSON rendering of Products
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from flask_restplus import marshal
+from service import render
+from service.service import product_model
+from tests.product_factory import ProductFactory
+
+
+######################################################################
+# R E N D E R   T E S T   C A S E S
+######################################################################
+class TestRender(unittest.TestCase):
+    """ Test Cases for the JSON rendering of Products """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.products = [ProductFactory(id=product_id) for product_id in range(1, 4)]
+        self.products[0].price = 5
+        self.products[1].name = "Café \"Crème\""
+
+    def test_render_like_marshal(self):
+        """ Render Products like marshal() with product_model """
+        expected = marshal([product.serialize() for product in self.products], product_model)
+        body = render.render_products(self.products)
+        self.assertTrue(body.endswith(b"\n"))
+        self.assertEqual(json.loads(body), json.loads(json.dumps(expected)))
+        self.assertEqual(list(json.loads(body)[0]), list(expected[0]))
+        self.assertIsInstance(json.loads(body)[0]["price"], float)
+
+    def test_render_rows(self):
+        """ Render rows of some columns with the types of product_model """
+        rows = [(product.name, product.price, product.id) for product in self.products]
+        data = json.loads(render.render_rows(rows, ("name", "price", "id")))
+        self.assertEqual(data[0], {"name": self.products[0].name, "price": 5.0, "id": "1"})
+        self.assertIsInstance(data[0]["price"], float)
+        # columns past the rendered fields are left out
+        self.assertEqual(json.loads(render.render_rows(rows, ("name",))), [{"name": product.name} for product in self.products])
+
+    def test_render_without_orjson(self):
+        """ Render Products with the json module when orjson is not installed """
+        with patch("service.render.orjson", None):
+            body = render.render_products(self.products)
+        self.assertEqual(json.loads(body), json.loads(render.render_products(self.products)))
+        self.assertEqual(render.dumps([]), b"[]\n")
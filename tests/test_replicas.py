@@ -0,0 +1,156 @@
+"""
+Test cases for the read replica routing
+
+"""
+import os
+import tempfile
+import itertools
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import event
+from flask_api import status  # HTTP Status Codes
+from service.models import db, Product
+from service.service import app, init_db, result_cache
+from service.replicas import PRIMARY_COOKIE
+
+
+######################################################################
+# R E P L I C A   T E S T   C A S E S
+######################################################################
+class TestReplicas(TestCase):
+    """ Test Cases for the read replica routing """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        init_db()
+        app.debug = False
+        app.testing = True
+        app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
+        cls.replica_path = os.path.join(tempfile.gettempdir(), "test-replica-{}.db".format(os.getpid()))
+
+    @classmethod
+    def tearDownClass(cls):
+        """ This runs once after the entire test suite """
+        if os.path.exists(cls.replica_path):
+            os.remove(cls.replica_path)
+
+    def setUp(self):
+        """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
+        db.session.remove()
+        app.config["SQLALCHEMY_BINDS"] = {"replica_0": "sqlite:///" + self.replica_path}
+        self.replica = db.get_engine(app, bind="replica_0")
+        db.drop_all()
+        db.create_all()
+        db.Model.metadata.drop_all(self.replica)
+        db.Model.metadata.create_all(self.replica)
+        Product.cache.clear()
+        result_cache.clear()
+        self.writer = app.test_client()
+        self.reader = app.test_client(use_cookies=False)
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+        db.drop_all()
+        app.config["SQLALCHEMY_BINDS"] = {}
+        self.replica.dispose()
+        self.context.pop()
+
+    def _create_product(self):
+        """ Creates a Product on the primary through the API """
+        resp = self.writer.post("/api/products", json={"name": "Cake", "category": "Food",
+                                                       "description": "Chocolate Cake", "price": 10.5})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp
+
+    def test_reads_go_to_replica(self):
+        """ Send the catalog reads of clients that did not write to the replica """
+        product_id = self._create_product().get_json()["id"]
+        resp = self.reader.get("/api/products")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        resp = self.reader.get("/api/products/{}".format(product_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.reader.get("/api/categories")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_writer_reads_own_writes(self):
+        """ Send the reads of a client that just wrote to the primary """
+        resp = self._create_product()
+        self.assertIn(PRIMARY_COOKIE, resp.headers["Set-Cookie"])
+        product_id = resp.get_json()["id"]
+        # a lookup on the replica caches the id as missing
+        resp = self.reader.get("/api/products/{}".format(product_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.writer.get("/api/products/{}".format(product_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.writer.get("/api/products")
+        self.assertEqual([product["id"] for product in resp.get_json()], [product_id])
+        # once the window is over the writer reads from the replica again
+        self.writer.set_cookie("localhost", PRIMARY_COOKIE, "0")
+        resp = self.writer.get("/api/products")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_one_replica_per_request(self):
+        """ Send every query of a request to the same replica """
+        path = self.replica_path + "-1"
+        app.config["SQLALCHEMY_BINDS"]["replica_1"] = "sqlite:///" + path
+        replicas = {bind: db.get_engine(app, bind=bind) for bind in ("replica_0", "replica_1")}
+        db.Model.metadata.create_all(replicas["replica_1"])
+        used = []
+        listeners = []
+        for bind, engine in replicas.items():
+            listeners.append((engine, lambda *_, bind=bind: used.append(bind)))
+            event.listen(engine, "before_cursor_execute", listeners[-1][1])
+        # a different replica on every pick
+        picks = itertools.cycle(["replica_0", "replica_1"])
+        try:
+            with patch("service.replicas.random.choice", side_effect=lambda _: next(picks)):
+                for _ in range(4):
+                    used.clear()
+                    result_cache.clear()
+                    resp = self.reader.get("/api/products")
+                    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                    # the generation and the rows come from the same replica
+                    self.assertGreater(len(used), 1)
+                    self.assertEqual(len(set(used)), 1)
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, "before_cursor_execute", listener)
+            replicas["replica_1"].dispose()
+            os.remove(path)
+
+    def test_replica_reads_not_cached(self):
+        """ Do not cache the Products read from a replica, which may be behind the primary """
+        product_id = int(self._create_product().get_json()["id"])
+        db.Model.metadata.drop_all(self.replica)
+        db.Model.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(Product.__table__.insert(), id=product_id, name="Old", category="Food",
+                               description="Lagging", price=1.0)
+        resp = self.reader.get("/api/products/{}".format(product_id))
+        self.assertEqual(resp.get_json()["name"], "Old")
+        self.assertIsNone(Product.cache.get(product_id))
+        # the primary fills the cache once replicas are gone
+        app.config["SQLALCHEMY_BINDS"] = {}
+        db.session.remove()
+        resp = self.reader.get("/api/products/{}".format(product_id))
+        self.assertEqual(resp.get_json()["name"], "Cake")
+        self.assertEqual(Product.cache.get(product_id)["name"], "Cake")
+
+    def test_replica_pool_stats(self):
+        """ Report the pools of the replicas """
+        resp = self.reader.get("/stats")
+        self.assertIn("replica_0", resp.get_json()["replica_pools"])
+
+    def test_no_replicas(self):
+        """ Do not pin writers to the primary without replicas """
+        app.config["SQLALCHEMY_BINDS"] = {}
+        db.session.remove()
+        resp = self._create_product()
+        self.assertNotIn("Set-Cookie", resp.headers)
+        resp = self.reader.get("/api/products")
+        self.assertEqual(len(resp.get_json()), 1)
@@ -6,13 +6,19 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import csv
+import json
+import base64
 import logging
 from unittest import TestCase
-from unittest.mock import patch
+import requests
+from unittest.mock import patch, MagicMock
 from flask_api import status  # HTTP Status Codes
-from service.models import db
-from service.service import app, init_db, internal_server_error
+from service.models import db, Product, Purchase, ChangeGeneration
+from service.service import app, init_db, internal_server_error, result_cache, release_connections, shopcart_client
+from service import shopcart, imports
 from tests.product_factory import ProductFactory
+from tests.shopcart_server import ShopcartServer
 
 SHOPCART_ENDPOINT = os.getenv('SHOPCART_ENDPOINT', 'http://localhost:5000/shopcarts')
 ######################################################################
@@ -29,21 +35,22 @@ class TestProductServer(TestCase):
         app.testing = True
         app.config["SQLALCHEMY_DATABASE_URI"] = app.config["TEST_DATABASE_URI"]
 
-    @classmethod
-    def tearDownClass(cls):
-        """ This runs once after the entire test suite """
-        db.session.close()
-
     def setUp(self):
         """ This runs before each test """
+        self.context = app.app_context()
+        self.context.push()
         self.app = app.test_client()
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        Product.cache.clear()
+        result_cache.clear()
+        shopcart.cart_ids.clear()
 
     def tearDown(self):
         """ This runs after each test """
         db.session.remove()
         db.drop_all()
+        self.context.pop()
 
     def _create_products(self, count):
         """ Factory method to create products in bulk """
@@ -70,6 +77,18 @@ class TestProductServer(TestCase):
         resp = self.app.get("/")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_stats(self):
+        """ Get the statistics of the pool and the caches """
+        test_product = self._create_products(1)[0]
+        self.app.get("/api/products/{}".format(test_product.id))
+        self.app.get("/api/products/{}".format(test_product.id))
+        resp = self.app.get("/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn("class", data["pool"])
+        self.assertGreaterEqual(data["product_cache"]["hits"], 1)
+        self.assertIn("misses", data["result_cache"])
+
     def test_create_product(self):
         """ Create a new Product """
         test_product = ProductFactory()
@@ -128,6 +147,59 @@ class TestProductServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_products_batch(self):
+        """ Create a batch of Products """
+        test_products = [ProductFactory().serialize() for _ in range(5)]
+        resp = self.app.post(
+            "/api/products:batch", json=test_products, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["errors"], [])
+        self.assertEqual(len(data["created"]), 5)
+        for created, test_product in zip(data["created"], test_products):
+            self.assertEqual(created["name"], test_product["name"])
+            resp = self.app.get("/api/products/{}".format(created["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/api/products")
+        self.assertEqual(len(resp.get_json()), 5)
+
+    def test_create_products_batch_with_errors(self):
+        """ Create a batch of Products where some are not valid """
+        test_products = [ProductFactory().serialize() for _ in range(4)]
+        test_products[1].pop("name")
+        test_products[3]["category"] = ""
+        resp = self.app.post(
+            "/api/products:batch", json=test_products, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(len(data["created"]), 2)
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 3])
+        self.assertIn("name", data["errors"][0]["message"])
+        resp = self.app.get("/api/products")
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_create_products_batch_bad_request(self):
+        """ Create a batch of Products with bad requests """
+        resp = self.app.post(
+            "/api/products:batch", json=[], content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(
+            "/api/products:batch", json=ProductFactory().serialize(), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(
+            "/api/products:batch", json=[{"name": "Cake"}], content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(resp.get_json()["errors"]), 1)
+        resp = self.app.post(
+            "/api/products:batch", json=[ProductFactory().serialize()], content_type="text/plain"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_get_product(self):
         """ Get a single product by its ID """
         # get the id of a product
@@ -137,6 +209,63 @@ class TestProductServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["name"], test_product.name)
 
+    def test_get_product_not_modified(self):
+        """ Get a Product that has not changed since its ETag """
+        test_product = self._create_products(1)[0]
+        resp = self.app.get("/api/products/{}".format(test_product.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/api/products/{}".format(test_product.id), headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        # an update changes the ETag
+        resp = self.app.put("/api/products/{}".format(test_product.id), json={"name": "Cake"}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.app.get("/api/products/{}".format(test_product.id), headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"], "Cake")
+        resp = self.app.get("/api/products/0", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_etag_matches_body(self):
+        """ Validate a Product against the same row whose body is served """
+        test_product = self._create_products(1)[0]
+        url = "/api/products/{}".format(test_product.id)
+        etag = self.app.get(url).headers["ETag"]
+        # another worker updates the row behind the cache of this one
+        db.session.execute("UPDATE product SET name = 'Cake', version = version + 1 WHERE id = :id",
+                           {"id": test_product.id})
+        db.session.commit()
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        Product.cache.clear()
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"], "Cake")
+        new_etag = resp.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        resp = self.app.get(url, headers={"If-None-Match": new_etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_product_list_not_modified(self):
+        """ Get a list of Products that has not changed since its ETag """
+        self._create_products(3)
+        resp = self.app.get("/api/products")
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/api/products", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # another query has another ETag
+        resp = self.app.get("/api/products", query_string="limit=1", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # any write to the catalog changes the ETag
+        self._create_products(1)
+        resp = self.app.get("/api/products", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 4)
+
     def test_get_product_not_found(self):
         """ Get a product that's not found """
         resp = self.app.get("/api/products/0")
@@ -159,6 +288,18 @@ class TestProductServer(TestCase):
         resp = self.app.get("/api/products/{}".format(test_product.id))
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_product_deleted_by_another_request(self):
+        """ Delete a Product that another request deletes at the same time """
+        test_product = self._create_products(1)[0]
+        product = Product.find(test_product.id, cached=False)
+        # another request deletes it between the lookup and the delete
+        self.app.delete("/api/products/{}".format(test_product.id))
+        with patch('service.models.Product.find', return_value=product):
+            resp = self.app.delete("/api/products/{}".format(test_product.id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/api/categories")
+        self.assertEqual(resp.get_json(), [])
+
     def test_delete_product_bad_request(self):
         """ Get a product with invalid product id """
         resp = self.app.delete("/api/products/a")
@@ -230,6 +371,26 @@ class TestProductServer(TestCase):
         updated_product = resp.get_json()
         self.assertEqual(updated_product["price"], test_product_price)
 
+    def test_write_product_changed_by_another_worker(self):
+        """ Update and delete the row in the database, not the cached copy of this worker """
+        test_product = self._create_products(1)[0]
+        url = "/api/products/{}".format(test_product.id)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+        # another worker changes the price behind the cache of this one
+        db.session.execute("UPDATE product SET price = 123.0, version = version + 1 WHERE id = :id",
+                           {"id": test_product.id})
+        db.session.commit()
+        resp = self.app.put(url, json={"name": "New name", "price": ""}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["price"], 123.0)
+        self.assertEqual(self.app.get(url).get_json()["price"], 123.0)
+        # and then deletes it
+        self.app.get(url)
+        db.session.execute("DELETE FROM product WHERE id = :id", {"id": test_product.id})
+        db.session.commit()
+        resp = self.app.put(url, json={"name": "Newer name"}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_update_product_not_found(self):
         """ Update a product that's not found """
         test_product = ProductFactory()
@@ -524,13 +685,323 @@ class TestProductServer(TestCase):
         resp = self.app.get("/api/products", query_string="maximum={}".format(test_max_price))
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_query_product_by_price_from_zero(self):
+        """ Query Products by a Price Range starting at zero """
+        products = self._create_products(5)
+        resp = self.app.get("/api/products", query_string="minimum=0&maximum=100000")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), len(products))
+
+    def test_query_product_list_cached(self):
+        """ Query Products from the result cache """
+        products = self._create_products(5)
+        test_category = products[0].category
+        resp = self.app.get("/api/products", query_string="category={}".format(test_category.upper()))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        with patch('service.models.Product.find_by') as find_by:
+            # the same query in another case is served from the cache
+            resp = self.app.get("/api/products", query_string="category={}".format(test_category.lower()))
+            find_by.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), data)
+        # a write invalidates every cached result
+        test_product = ProductFactory()
+        test_product.category = test_category
+        resp = self.app.post("/api/products", json=test_product.serialize(), content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("/api/products", query_string="category={}".format(test_category))
+        self.assertEqual(len(resp.get_json()), len(data) + 1)
+
+    def test_get_product_list_paginated(self):
+        """ Page through the list of Products with a cursor """
+        products = self._create_products(5)
+        resp = self.app.get("/api/products", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        seen = []
+        while True:
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(int(product["id"]) for product in data)
+            link = resp.headers.get("Link")
+            if link is None:
+                break
+            self.assertTrue(link.endswith('>; rel="next"'))
+            resp = self.app.get(link[1:link.index(">")])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(seen, sorted(int(product.id) for product in products))
+
+    def test_query_product_list_paginated(self):
+        """ Page through Products queried by Category """
+        products = self._create_products(10)
+        test_category = products[0].category
+        category_products = [product for product in products if product.category == test_category]
+        resp = self.app.get("/api/products", query_string="category={}&limit=1".format(test_category))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        count = 0
+        while True:
+            data = resp.get_json()
+            count += len(data)
+            for product in data:
+                self.assertEqual(product["category"], test_category)
+            link = resp.headers.get("Link")
+            if link is None:
+                break
+            self.assertIn("category={}".format(test_category), link)
+            resp = self.app.get(link[1:link.index(">")])
+        self.assertEqual(count, len(category_products))
+
+    def test_get_product_list_fields(self):
+        """ Get a list of Products with only some of their fields """
+        products = self._create_products(3)
+        resp = self.app.get("/api/products", query_string="fields=price,id, name")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([list(product) for product in data], [["name", "price", "id"]] * 3)
+        self.assertEqual(data[0], {"name": products[0].name, "price": products[0].price, "id": products[0].id})
+        # the cursor still pages by id when the id is not returned
+        resp = self.app.get("/api/products", query_string="fields=name&limit=2")
+        self.assertEqual(resp.get_json(), [{"name": product.name} for product in products[:2]])
+        resp = self.app.get(resp.headers["Link"][1:resp.headers["Link"].index(">")])
+        self.assertEqual(resp.get_json(), [{"name": products[2].name}])
+        resp = self.app.get("/api/products", query_string="fields=name,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_list_sorted(self):
+        """ Page through a sorted list of Products """
+        products = self._create_products(7)
+        order = sorted(products, key=lambda product: (-product.price, product.name, int(product.id)))
+        resp = self.app.get("/api/products", query_string="sort=-price,name")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["id"] for product in resp.get_json()], [product.id for product in order])
+        # the sort fields are carried by the cursor even when they are not returned
+        resp = self.app.get("/api/products", query_string="sort=-price,name&limit=3&fields=id")
+        seen = []
+        while True:
+            seen.extend(product["id"] for product in resp.get_json())
+            link = resp.headers.get("Link")
+            if link is None:
+                break
+            resp = self.app.get(link[1:link.index(">")])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(seen, [product.id for product in order])
+        for sort in ("secret", "price,price", "--price", "price,"):
+            resp = self.app.get("/api/products", query_string={"sort": sort})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # a cursor of another sort
+        resp = self.app.get("/api/products", query_string="limit=1")
+        cursor = resp.headers["Link"].split("cursor=")[1].split(">")[0]
+        resp = self.app.get("/api/products", query_string={"sort": "price", "cursor": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_list_bad_pagination(self):
+        """ Get a list of Products with an invalid limit or cursor """
+        resp = self.app.get("/api/products", query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/products", query_string="limit=100000")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/products", query_string="cursor=bogus")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # edited cursors whose values do not fit the columns they are compared with
+        for sort, data in (("price", {"id": 1, "after": ["abc"]}), ("price", {"id": 1, "after": [[1]]}),
+                           ("name", {"id": 1, "after": [1]}), ("-id", {"id": 1, "after": [1.5]}),
+                           (None, {"id": True}), (None, {"id": "1"})):
+            cursor = base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).decode("ascii")
+            resp = self.app.get("/api/products", query_string={"sort": sort, "cursor": cursor})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, data)
+        cursor = base64.urlsafe_b64encode(b'{"id": 1, "after": [10]}').decode("ascii")
+        resp = self.app.get("/api/products", query_string={"sort": "price", "cursor": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_export_products(self):
+        """ Export Products as CSV and NDJSON """
+        products = self._create_products(5)
+        resp = self.app.get("/api/products/export.csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "text/csv")
+        lines = list(csv.reader(resp.get_data(as_text=True).splitlines()))
+        self.assertEqual(lines[0], ["name", "category", "description", "price", "id"])
+        self.assertEqual(lines[1:], [[product.name, product.category, product.description, str(product.price), product.id]
+                                     for product in products])
+        category = products[0].category
+        resp = self.app.get("/api/products/export.ndjson", query_string={"category": category, "fields": "id,name"})
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(rows, [{"name": product.name, "id": product.id} for product in products if product.category == category])
+        resp = self.app.get("/api/products/export.ndjson", query_string="minimum=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # any other extension is read as a product id
+        resp = self.app.get("/api/products/export.xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_facets(self):
+        """ Count the queried Products by category and price """
+        for name, category, price in (("Cake", "Food", 5), ("Pie", "food", 150), ("Bread", "Food", 199.99),
+                                      ("iPhone", "Technology", 999), ("Cable", "Technology", 10)):
+            Product(name=name, description=name, category=category, price=price).create()
+        resp = self.app.get("/api/products/facets")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {
+            "total": 5,
+            "categories": [{"category": "food", "count": 3}, {"category": "technology", "count": 2}],
+            "prices": [{"minimum": 0, "maximum": 100, "count": 2}, {"minimum": 100, "maximum": 200, "count": 2},
+                       {"minimum": 900, "maximum": 1000, "count": 1}]
+        })
+        resp = self.app.get("/api/products/facets", query_string="minimum=100&maximum=1000&width=500&name=I")
+        self.assertEqual(resp.get_json(), {
+            "total": 2,
+            "categories": [{"category": "food", "count": 1}, {"category": "technology", "count": 1}],
+            "prices": [{"minimum": 0, "maximum": 500, "count": 1}, {"minimum": 500, "maximum": 1000, "count": 1}]
+        })
+        resp = self.app.get("/api/products/facets", headers={"If-None-Match": resp.headers["ETag"]},
+                            query_string="minimum=100&maximum=1000&width=500&name=i")
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        for width in ("0", "nan", "inf", "-inf", "1e-300"):
+            resp = self.app.get("/api/products/facets", query_string={"width": width})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, width)
+        # 999 / 0.05 buckets over all prices, but few enough under a maximum
+        resp = self.app.get("/api/products/facets", query_string="width=0.05")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/products/facets", query_string="width=0.05&minimum=0&maximum=200")
+        self.assertEqual(resp.get_json()["total"], 4)
+        resp = self.app.get("/api/products/facets", query_string="minimum=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_shopcart_client_configured(self):
+        """ Configure the shopcart client from the application on its first use """
+        with patch.object(shopcart, "configured", False), patch.dict(app.config, {"SHOPCART_ID_CACHE_SIZE": 7}):
+            self.assertIs(shopcart_client(), shopcart)
+            self.assertEqual(shopcart.cart_ids.maxsize, 7)
+            cart_ids = shopcart.cart_ids
+            shopcart_client()
+            self.assertIs(shopcart.cart_ids, cart_ids)
+        shopcart.init_client(app.config)
+
+    def test_release_connections(self):
+        """ Close the connections of the process before forking workers """
+        self._create_products(1)
+        session = shopcart.session
+        release_connections()
+        self.assertIsNot(shopcart.session, session)
+        # the next request opens new connections
+        resp = self.app.get("/api/products")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+
+    def test_list_categories(self):
+        """ List the statistics of the categories """
+        resp = self.app.get("/api/categories")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        for name, category, price in (("Cake", "Food", 10.0), ("Pie", "food", 5.0), ("iPhone", "Technology", 999.0)):
+            resp = self.app.post("/api/products", json={"name": name, "category": category,
+                                                        "description": name, "price": price})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        pie = self.app.get("/api/products", query_string="name=Pie").get_json()[0]
+        pie["price"] = 20.0
+        resp = self.app.put("/api/products/{}".format(pie["id"]), json=pie, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/api/categories")
+        self.assertEqual(resp.get_json(), [
+            {"category": "food", "count": 2, "min_price": 10, "max_price": 20, "avg_price": 15},
+            {"category": "technology", "count": 1, "min_price": 999, "max_price": 999, "avg_price": 999}
+        ])
+        resp = self.app.delete("/api/products/{}".format(pie["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/api/categories")
+        self.assertEqual(resp.get_json()[0], {"category": "food", "count": 1, "min_price": 10, "max_price": 10, "avg_price": 10})
+
+    def test_import_products_csv(self):
+        """ Import Products from a CSV upload """
+        upload = (
+            "name,description,category,price\n"
+            "Cake,Chocolate Cake,Food,10.50\n"
+            "Bad,Bad price,Food,abc\n"
+            "\"Phone, X\",\"Black\nPhone\",Technology,999\n"
+            ",No name,Food,1\n"
+        )
+        resp = self.app.post("/api/products/imports", data=upload, content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(imports.process(app))
+        resp = self.app.get(resp.headers["Location"])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        job = resp.get_json()
+        self.assertEqual(job["status"], "done")
+        self.assertEqual((job["lines"], job["imported"], job["rejected"]), (4, 2, 2))
+        self.assertEqual(job["errors"], [{"line": 3, "message": "Invalid Price Input"},
+                                         {"line": 6, "message": "Fields cannot be empty."}])
+        data = self.app.get("/api/products").get_json()
+        self.assertEqual([(product["name"], product["price"]) for product in data], [("Cake", 10.5), ("Phone, X", 999.0)])
+        self.assertEqual(data[1]["description"], "Black\nPhone")
+        categories = self.app.get("/api/categories").get_json()
+        self.assertEqual([(category["category"], category["count"]) for category in categories], [("food", 1), ("technology", 1)])
+
+    def test_import_products_ndjson(self):
+        """ Import Products from an NDJSON upload """
+        upload = (
+            '{"name": "Cake", "description": "Chocolate Cake", "category": "Food", "price": "10.50"}\n'
+            '\n'
+            '{"name": "Cake"\n'
+            '{"name": "%s", "description": "Long", "category": "Food", "price": "1"}\n' % ("x" * 64)
+        )
+        resp = self.app.post("/api/products/imports", data=upload, content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(imports.process(app))
+        job = self.app.get(resp.headers["Location"]).get_json()
+        self.assertEqual((job["lines"], job["imported"], job["rejected"]), (3, 1, 2))
+        self.assertEqual([error["line"] for error in job["errors"]], [3, 4])
+        self.assertEqual(job["errors"][0]["message"], "Invalid JSON")
+
+    def test_import_products_in_chunks(self):
+        """ Import an upload in chunks of rows, each in its own transaction """
+        upload = "name,description,category,price\n" + "Cake,Chocolate Cake,Food,1.5\n" * 5
+        generation = ChangeGeneration.current()
+        with patch.dict(app.config, {"IMPORT_CHUNK_SIZE": 2}):
+            resp = self.app.post("/api/products/imports", data=upload, content_type="text/csv")
+            self.assertTrue(imports.process(app))
+        job = self.app.get(resp.headers["Location"]).get_json()
+        self.assertEqual(job["imported"], 5)
+        self.assertEqual(ChangeGeneration.current(), generation + 3)
+
+    def test_import_products_bad_request(self):
+        """ Import Products from an upload of an unsupported type """
+        resp = self.app.post("/api/products/imports", data="[]", content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.get("/api/products/imports/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search_products(self):
+        """ Search Products by name and description """
+        products = self._create_products(10)
+        test_name = products[0].name
+        resp = self.app.get("/api/products/search", query_string={"q": test_name})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertGreaterEqual(len(data), len([product for product in products if product.name == test_name]))
+        for product in data:
+            self.assertIn(test_name.split()[0].lower(), (product["name"] + product["description"]).lower())
+        resp = self.app.get("/api/products/search", query_string={"q": test_name, "limit": 1})
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get("/api/products/search", query_string={"q": "nothing matches this"})
+        self.assertEqual(resp.get_json(), [])
+
+    def test_search_products_bad_request(self):
+        """ Search Products with bad requests """
+        resp = self.app.get("/api/products/search")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/products/search", query_string={"q": " "})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/products/search", query_string={"q": "cake", "limit": 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_purchase_product_shopcart_exists(self):
         '''Purchase a Product Shopcart Exists Successfully'''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": 4}
                 product = self._create_products(1)
@@ -541,12 +1012,12 @@ class TestProductServer(TestCase):
     def test_purchase_product_shopcart_no_exist(self):
         '''Purchase a Product Shopcart Doesn't Exist Successfully'''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = []
-            with patch('service.service.create_shopcart') as create_shopcart_mock:
+            with patch('service.shopcart.create_shopcart') as create_shopcart_mock:
                 create_shopcart_mock.return_value.status_code=201
-                with patch('service.service.add_item_to_shopcart') as post_shopcartitem_mock:
+                with patch('service.shopcart.add_item_to_shopcart') as post_shopcartitem_mock:
                     post_shopcartitem_mock.return_value.status_code=201
                     json = {"user_id": user_id, "amount": 4}
                     product = self._create_products(1)
@@ -557,10 +1028,10 @@ class TestProductServer(TestCase):
     def test_purchase_product_not_found(self):
         '''Purchase a Product That's Not Found'''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": 4}
                 resp = self.app.post("/api/products/1/purchase", json=json, content_type="application/json")
@@ -569,10 +1040,10 @@ class TestProductServer(TestCase):
     def test_purchase_product_cannot_add_shopcart(self):
         '''Purchase a Product Not Added Into Shopcart (Shopcart Exists) '''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=400
                 json = {"user_id": user_id, "amount": 4}
                 product = self._create_products(1)
@@ -583,10 +1054,10 @@ class TestProductServer(TestCase):
     def test_purchase_product_empty_user_id(self):
         '''Purchase a Product Empty User ID'''
         user_id = ""
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": 4}
                 product = self._create_products(1)
@@ -597,10 +1068,10 @@ class TestProductServer(TestCase):
     def test_purchase_product_empty_amount(self):
         '''Purchase a Product Empty Amount '''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": ""}
                 product = self._create_products(1)
@@ -611,10 +1082,10 @@ class TestProductServer(TestCase):
     def test_purchase_product_id_not_int(self):
         '''Purchase a Product ID not Int '''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": 4}
                 resp = self.app.post("/api/products/{}/purchase".format("test"), json=json, content_type="application/json")
@@ -624,10 +1095,10 @@ class TestProductServer(TestCase):
     def test_purchase_amount_not_int(self):
         '''Purchase a Product Amount not Int '''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": "hello"}
                 product = self._create_products(1)
@@ -638,10 +1109,10 @@ class TestProductServer(TestCase):
     def test_purchase_user_id_not_int(self):
         '''Purchase a Product User ID not Int '''
         user_id = "testing"
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = [{"create_time": "2020-11-15T19:36:28.302839","id": 6,"update_time": "2020-11-15T19:36:28.302839","user_id": 101}]
-            with patch('service.service.add_item_to_shopcart') as post_shopcart_item_mock:
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
                 post_shopcart_item_mock.return_value.status_code=201
                 json = {"user_id": user_id, "amount": 4}
                 product = self._create_products(1)
@@ -652,10 +1123,10 @@ class TestProductServer(TestCase):
     def test_purchase_unsuccessful_product_shopcart_error(self):
         '''Purchase a Product Shopcart Doesn't Exist (ShopCart Creation Error)'''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = []
-            with patch('service.service.create_shopcart') as create_shopcart_mock:
+            with patch('service.shopcart.create_shopcart') as create_shopcart_mock:
                 create_shopcart_mock.return_value.status_code=400
                 json = {"user_id": user_id, "amount": 4}
                 product = self._create_products(1)
@@ -666,12 +1137,12 @@ class TestProductServer(TestCase):
     def test_purchase_product_shopcart_unsuccessful_product(self):
         '''Purchase a Product (Product Adding Error) '''
         user_id = 101
-        with patch('requests.get') as get_shopcart_by_userid_mock:
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
             get_shopcart_by_userid_mock.return_value.status_code = 200
             get_shopcart_by_userid_mock.return_value.json.return_value = []
-            with patch('service.service.create_shopcart') as create_shopcart_mock:
+            with patch('service.shopcart.create_shopcart') as create_shopcart_mock:
                 create_shopcart_mock.return_value.status_code=201
-                with patch('service.service.add_item_to_shopcart') as post_shopcartitem_mock:
+                with patch('service.shopcart.add_item_to_shopcart') as post_shopcartitem_mock:
                     post_shopcartitem_mock.return_value.status_code=400
                     json = {"user_id": user_id, "amount": 4}
                     product = self._create_products(1)
@@ -679,6 +1150,130 @@ class TestProductServer(TestCase):
                     self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
                     self.assertEqual(resp.data, b'{"message": "Product not successfully added into the shopping cart"}\n')
 
+    def test_purchase_product_shopcart_unavailable(self):
+        '''Purchase a Product When the Shopcart Service Is Unavailable'''
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
+            get_shopcart_by_userid_mock.side_effect = requests.ConnectionError
+            json = {"user_id": 101, "amount": 4}
+            product = self._create_products(1)
+            resp = self.app.post("/api/products/{}/purchase".format(product[0].id), json=json, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.data, b'{"message": "Shopcart service is unavailable"}\n')
+
+    def test_purchase_product_cached_shopcart(self):
+        '''Purchase Twice Looking Up the Shopcart Once'''
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
+            get_shopcart_by_userid_mock.return_value.status_code = 200
+            get_shopcart_by_userid_mock.return_value.json.return_value = [{"id": 6, "user_id": 101}]
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
+                post_shopcart_item_mock.return_value.status_code = 201
+                json = {"user_id": 101, "amount": 4}
+                product = self._create_products(1)
+                for _ in range(2):
+                    resp = self.app.post("/api/products/{}/purchase".format(product[0].id), json=json, content_type="application/json")
+                    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                get_shopcart_by_userid_mock.assert_called_once()
+                self.assertEqual(post_shopcart_item_mock.call_count, 2)
+                self.assertTrue(post_shopcart_item_mock.call_args[0][0].endswith("/6/items"))
+        self.assertEqual(shopcart.cart_ids.get(101), 6)
+
+    def test_purchase_product_stale_cached_shopcart(self):
+        '''Purchase Again After the Cached Shopcart Was Deleted'''
+        shopcart.cart_ids.set(101, 6)
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
+            get_shopcart_by_userid_mock.return_value.status_code = 200
+            get_shopcart_by_userid_mock.return_value.json.return_value = [{"id": 7, "user_id": 101}]
+            with patch('service.shopcart.add_item_to_shopcart') as post_shopcart_item_mock:
+                post_shopcart_item_mock.side_effect = [MagicMock(status_code=404), MagicMock(status_code=201)]
+                json = {"user_id": 101, "amount": 4}
+                product = self._create_products(1)
+                resp = self.app.post("/api/products/{}/purchase".format(product[0].id), json=json, content_type="application/json")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                get_shopcart_by_userid_mock.assert_called_once()
+                self.assertTrue(post_shopcart_item_mock.call_args_list[0][0][0].endswith("/6/items"))
+                self.assertTrue(post_shopcart_item_mock.call_args_list[1][0][0].endswith("/7/items"))
+        self.assertEqual(shopcart.cart_ids.get(101), 7)
+
+    def test_purchase_product_circuit_open(self):
+        '''Purchase a Product While the Circuit to the Shopcart Service Is Open'''
+        with patch('service.shopcart.breaker') as breaker_mock, \
+                patch('service.shopcart.session') as session_mock:
+            breaker_mock.allow.return_value = False
+            json = {"user_id": 101, "amount": 4}
+            product = self._create_products(1)
+            resp = self.app.post("/api/products/{}/purchase".format(product[0].id), json=json, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            session_mock.request.assert_not_called()
+
+    def test_purchase_product_async(self):
+        '''Queue a Purchase and Retrieve Its Status'''
+        product = self._create_products(1)
+        with patch('service.shopcart.session') as session_mock:
+            resp = self.app.post("/api/products/{}/purchase".format(product[0].id), json={"user_id": 101, "amount": 4},
+                                 content_type="application/json", headers={"Prefer": "respond-async"})
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+            session_mock.request.assert_not_called()
+        self.assertEqual(resp.headers["Preference-Applied"], "respond-async")
+        queued = resp.get_json()
+        self.assertEqual(queued["status"], Purchase.PENDING)
+        self.assertEqual(queued["product_id"], int(product[0].id))
+        resp = self.app.get(resp.headers["Location"])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["id"], queued["id"])
+        self.assertEqual(resp.get_json()["amount"], 4)
+
+    def test_get_purchase_not_found(self):
+        '''Get the Status of a Purchase that Does Not Exist'''
+        resp = self.app.get("/api/purchases/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_purchase_products_batch(self):
+        '''Purchase a List of Products with One Shopcart Lookup'''
+        products = self._create_products(3)
+        items = [{"id": int(product.id), "amount": amount} for amount, product in enumerate(products, 1)]
+        with ShopcartServer() as server, patch('service.service.SHOPCART_ENDPOINT', server.endpoint):
+            resp = self.app.post("/api/purchases", json={"user_id": 101, "items": items}, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # one lookup, one creation and one call per item
+            self.assertEqual(server.requests, 5)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["code"] for result in results], [200, 200, 200])
+        self.assertEqual(results[0]["message"], "Product successfully added into the shopping cart")
+        cart = server.carts[1]
+        self.assertEqual(cart["user_id"], 101)
+        self.assertEqual(sorted(item["amount"] for item in cart["items"]), [1, 2, 3])
+
+    def test_purchase_products_batch_partial(self):
+        '''Purchase a List of Products Some of Which Are Not Valid'''
+        product = self._create_products(1)[0]
+        items = [{"id": int(product.id), "amount": 2}, {"id": "x", "amount": 1}, {"id": 0, "amount": 1}]
+        with ShopcartServer() as server, patch('service.service.SHOPCART_ENDPOINT', server.endpoint):
+            resp = self.app.post("/api/purchases", json={"user_id": 101, "items": items}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["code"] for result in results], [200, 400, 404])
+        self.assertEqual([result["index"] for result in results], [0, 1, 2])
+        self.assertEqual(len(server.carts[1]["items"]), 1)
+
+    def test_purchase_products_batch_bad_request(self):
+        '''Purchase a List of Products Without a Valid Item'''
+        resp = self.app.post("/api/purchases", json={"user_id": 101, "items": [{"id": 0, "amount": 1}]}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["results"][0]["code"], 404)
+        resp = self.app.post("/api/purchases", json={"user_id": 101, "items": []}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/api/purchases", json={"user_id": "x", "items": [{"id": 1, "amount": 1}]}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purchase_products_batch_unavailable(self):
+        '''Purchase a List of Products When the Shopcart Service Is Unavailable'''
+        product = self._create_products(1)[0]
+        with patch('service.shopcart.get_shopcarts') as get_shopcart_by_userid_mock:
+            get_shopcart_by_userid_mock.side_effect = requests.ConnectionError
+            resp = self.app.post("/api/purchases", json={"user_id": 101, "items": [{"id": int(product.id), "amount": 1}]},
+                                 content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
     def test_data_validation_error(self):
         '''Data Validation Error '''
         test_product = ProductFactory()
@@ -0,0 +1,157 @@
+"""
+Test cases for the Shopcart Client
+
+"""
+import unittest
+from unittest.mock import patch
+import requests
+from service import shopcart
+from tests.shopcart_server import ShopcartServer
+
+HEADER = {'Content-Type': 'application/json'}
+
+
+######################################################################
+# S H O P C A R T   C L I E N T   T E S T   C A S E S
+######################################################################
+class TestShopcartClient(unittest.TestCase):
+    """ Test Cases for the Shopcart Client """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.session = shopcart.session
+        shopcart.session = shopcart.build_session(connect_timeout=0.5, read_timeout=0.5, retries=2, backoff=0)
+        self.breaker = shopcart.breaker
+        shopcart.breaker = shopcart.CircuitBreaker(failure_rate=0.5, window=4, min_calls=4, reset_timeout=60)
+        shopcart.latency.clear()
+
+    def tearDown(self):
+        """ This runs after each test """
+        shopcart.session = self.session
+        shopcart.breaker = self.breaker
+
+    def test_shopcart_calls(self):
+        """ Look up, create and add items to shopcarts """
+        with ShopcartServer() as server:
+            resp = shopcart.get_shopcarts(server.endpoint, 7)
+            self.assertEqual(resp.json(), [])
+            resp = shopcart.create_shopcart(server.endpoint, HEADER, {"user_id": 7})
+            self.assertEqual(resp.status_code, 201)
+            cart_id = resp.json()["id"]
+            resp = shopcart.add_item_to_shopcart("{}/{}/items".format(server.endpoint, cart_id), HEADER, {"sku": 1})
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(shopcart.get_shopcarts(server.endpoint, 7).json()[0]["id"], cart_id)
+            # every call went over the same kept-alive connection
+            self.assertEqual(len(server.connections), 1)
+        stats = shopcart.latency.stats()
+        self.assertEqual(stats["get_shopcarts"]["count"], 2)
+        self.assertEqual(stats["create_shopcart"]["count"], 1)
+        self.assertEqual(stats["add_item_to_shopcart"]["errors"], 0)
+
+    def test_add_purchases(self):
+        """ Add items concurrently, looking the shopcart up again if the cached one is gone """
+        shopcart.cart_ids.clear()
+        with ShopcartServer() as server:
+            results = shopcart.add_purchases(server.endpoint, HEADER, 7, [{"sku": 1}, {"sku": 2}])
+            self.assertEqual(results, [(200, shopcart.ADDED)] * 2)
+            self.assertEqual(server.requests, 4)
+            del server.carts[1]
+            results = shopcart.add_purchases(server.endpoint, HEADER, 7, [{"sku": 3}])
+            self.assertEqual(results, [(200, shopcart.ADDED)])
+        self.assertEqual(shopcart.cart_ids.get(7), 2)
+        self.assertEqual(server.carts[2]["items"], [{"sku": 3}])
+
+    def test_retry_idempotent_calls(self):
+        """ Retry lookups that failed with 503 """
+        with ShopcartServer() as server:
+            server.failures = 2
+            resp = shopcart.get_shopcarts(server.endpoint, 7)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(server.requests, 3)
+
+    def test_do_not_retry_posts(self):
+        """ Do not retry creating a shopcart after the service answered """
+        with ShopcartServer() as server:
+            server.failures = 1
+            resp = shopcart.create_shopcart(server.endpoint, HEADER, {"user_id": 7})
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(server.requests, 1)
+        self.assertEqual(shopcart.latency.stats()["create_shopcart"]["errors"], 1)
+
+    def test_timeout(self):
+        """ Give up on a shopcart service that does not answer in time """
+        with ShopcartServer(delay=1) as server:
+            shopcart.session = shopcart.build_session(read_timeout=0.1, retries=0)
+            self.assertRaises(requests.Timeout, shopcart.create_shopcart, server.endpoint, HEADER, {"user_id": 7})
+        self.assertEqual(shopcart.latency.stats()["create_shopcart"]["errors"], 1)
+
+    def test_jitter(self):
+        """ Randomize the backoff between retries """
+        retry = shopcart.JitterRetry(total=5, backoff_factor=1).increment().increment().increment()
+        with patch('random.uniform') as uniform:
+            uniform.return_value = 0.5
+            self.assertEqual(retry.get_backoff_time(), 0.5)
+            uniform.assert_called_once_with(0, 4)
+
+    def test_init_client(self):
+        """ Build the session from the configuration """
+        config = {"SHOPCART_CONNECT_TIMEOUT": 2, "SHOPCART_READ_TIMEOUT": 4, "SHOPCART_RETRIES": 1,
+                  "SHOPCART_BACKOFF": 0.5, "SHOPCART_POOL_SIZE": 3,
+                  "SHOPCART_ID_CACHE_SIZE": 5, "SHOPCART_ID_CACHE_TTL": 10,
+                  "SHOPCART_BREAKER_FAILURE_RATE": 0.25, "SHOPCART_BREAKER_WINDOW": 8,
+                  "SHOPCART_BREAKER_MIN_CALLS": 4, "SHOPCART_BREAKER_RESET_TIMEOUT": 5}
+        shopcart.init_client(config)
+        adapter = shopcart.session.get_adapter("http://localhost")
+        self.assertEqual(adapter.timeout, (2, 4))
+        self.assertEqual(adapter.max_retries.total, 1)
+        self.assertEqual(adapter._pool_maxsize, 3)  # pylint: disable=protected-access
+        self.assertEqual(shopcart.cart_ids.maxsize, 5)
+        self.assertEqual(shopcart.breaker.reset_timeout, 5)
+
+    def test_circuit_breaker(self):
+        """ Open the circuit on failures and close it after a successful trial """
+        now = [0.0]
+        breaker = shopcart.CircuitBreaker(failure_rate=0.5, window=4, min_calls=4, reset_timeout=10, clock=lambda: now[0])
+        for failed in (False, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record(failed)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+        # a single trial call once the reset timeout has passed
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.stats()["opened"], 2)
+        self.assertEqual(breaker.stats()["rejected"], 2)
+
+    def test_fail_fast_when_open(self):
+        """ Do not call the shopcart service while the circuit is open """
+        with ShopcartServer() as server:
+            server.failures = 100
+            for _ in range(4):
+                shopcart.create_shopcart(server.endpoint, HEADER, {"user_id": 7})
+            self.assertEqual(server.requests, 4)
+            self.assertRaises(shopcart.CircuitOpenError, shopcart.get_shopcarts, server.endpoint, 7)
+            self.assertEqual(server.requests, 4)
+        self.assertEqual(shopcart.breaker.stats()["state"], "open")
+
+    def test_lookup_rejected(self):
+        """ Answer a rejected shopcart lookup instead of treating the service as unavailable """
+        shopcart.cart_ids.clear()
+        with patch("service.shopcart.get_shopcarts") as get_shopcarts:
+            get_shopcarts.return_value.status_code = 400
+            self.assertEqual(shopcart.add_purchase("http://shopcart", HEADER, 7, {"sku": 1}),
+                             (400, shopcart.CANNOT_CREATE))
+            get_shopcarts.return_value.status_code = 502
+            get_shopcarts.return_value.raise_for_status.side_effect = requests.HTTPError("502")
+            self.assertRaises(requests.HTTPError, shopcart.add_purchase, "http://shopcart", HEADER, 7, {"sku": 1})
@@ -0,0 +1,47 @@
+"""
+Test cases for the startup of the service
+
+"""
+import os
+import sys
+import json
+import subprocess
+from unittest import TestCase
+from service import app
+
+# Seconds a fresh worker may take to import the service and check its schema
+STARTUP_BUDGET = 1.0
+# Times the startup in a fresh interpreter and lists the modules it loaded
+STARTUP_SCRIPT = (
+    "import sys, json, time; started = time.perf_counter(); import service; "
+    "print(json.dumps({'seconds': time.perf_counter() - started, 'modules': "
+    "sorted(name for name in sys.modules if name.split('.')[0] in ('requests', 'service'))}))"
+)
+
+
+######################################################################
+#  S T A R T U P   T E S T   C A S E S
+######################################################################
+class TestStartup(TestCase):
+    """ Test Cases for the startup of a worker """
+
+    @staticmethod
+    def _start():
+        """ Starts the service in a new interpreter and returns what it reported """
+        env = dict(os.environ, DATABASE_URI=app.config["TEST_DATABASE_URI"])
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return json.loads(output.splitlines()[-1])
+
+    def test_startup_budget(self):
+        """ Start the service within its budget """
+        # the best of a few starts, so a busy machine does not fail the test
+        seconds = min(self._start()["seconds"] for _ in range(3))
+        self.assertLess(seconds, STARTUP_BUDGET)
+
+    def test_purchase_client_loaded_lazily(self):
+        """ Start the service without loading the shopcart client """
+        modules = self._start()["modules"]
+        self.assertIn("service.service", modules)
+        self.assertNotIn("service.shopcart", modules)
+        self.assertNotIn("requests", modules)